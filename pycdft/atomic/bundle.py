@@ -0,0 +1,61 @@
+""" Packed binary bundle of the spherically averaged atomic densities in rho/.
+
+All *.spavr files are stored in a single structured .npy file, with negative tails clipped
+and each density normalized to the number of valence electrons of its SG15 pseudopotential.
+The bundle is memory mapped on first use, so only the species actually requested are read.
+
+Regenerate the bundle after adding or changing *.spavr files with::
+
+    python -m pycdft.atomic.bundle
+"""
+
+import os
+import glob
+import numpy as np
+from pycdft.atomic import rho_path, rd_grid, drd
+from pycdft.atomic.pp import SG15PP
+
+bundle_file = os.path.join(rho_path, "rho.npy")
+bundle_dtype = np.dtype([("symbol", "U2"), ("rho", np.float64, (len(rd_grid),))])
+
+_bundle = None
+
+
+def read_spavr(symbol: str):
+    """ Read the radial density of a species from its text file and normalize it to nel."""
+    rho_rd = np.loadtxt(os.path.join(rho_path, "{}.spavr".format(symbol)), dtype=float)[:, 1]
+    rho_rd[rho_rd < 0] = 0
+    # rho(G=0) = 4 pi int( rho(r) r^2 ) = nel
+    rho_rd *= SG15PP[symbol]["nel"] / (4 * np.pi * drd * np.sum(rho_rd * rd_grid ** 2))
+    return rho_rd
+
+
+def build_bundle(fname: str = bundle_file):
+    """ Pack all *.spavr files into a single bundle."""
+    symbols = sorted(os.path.basename(f)[:-len(".spavr")]
+                     for f in glob.glob(os.path.join(rho_path, "*.spavr")))
+    bundle = np.zeros(len(symbols), dtype=bundle_dtype)
+    for i, symbol in enumerate(symbols):
+        bundle[i] = symbol, read_spavr(symbol)
+    np.save(fname, bundle)
+    return bundle
+
+
+def load_rho_rd(symbol: str):
+    """ Get the normalized radial density of a species.
+
+    Falls back to the text file if the bundle is missing or does not contain the species.
+    """
+    global _bundle
+    if _bundle is None and os.path.exists(bundle_file):
+        _bundle = np.load(bundle_file, mmap_mode="r")
+    if _bundle is not None:
+        i = np.searchsorted(_bundle["symbol"], symbol)
+        if i < len(_bundle) and _bundle["symbol"][i] == symbol:
+            return np.array(_bundle["rho"][i])
+    return read_spavr(symbol)
+
+
+if __name__ == "__main__":
+    bundle = build_bundle()
+    print("Packed {} species into {}".format(len(bundle), bundle_file))
@@ -0,0 +1,52 @@
+""" On-disk cache of atomic charge densities on FFT grids. """
+
+import os
+import hashlib
+import numpy as np
+from pycdft.common.fileio import atomic_write
+
+
+class RhoatomCache:
+    """ Content-addressed cache of atomic charge densities rho(G) on FFT grids.
+
+    Each entry is a .npy file named by the SHA-1 hash of the species, the lattice vectors,
+    the FFT grid and the content of the data the density was computed from. Entries are
+    loaded read-only with memory mapping.
+
+    Attributes:
+        path (str): directory holding the cache entries.
+    """
+
+    # bump when the way rho(G) is computed changes, to invalidate existing entries
+    version = 2
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, symbol: str, R: np.ndarray, shape: tuple, source: bytes):
+        """ Compute the key of an entry.
+
+        Args:
+            symbol (str): chemical symbol of the species.
+            R (np.ndarray, shape = [3, 3]): lattice vectors in bohr.
+            shape (3-tuple of int): FFT grid.
+            source (bytes): content of the data the atomic density is computed from.
+        """
+        h = hashlib.sha1()
+        h.update("v{} {} {} {} {}".format(self.version, symbol, *shape).encode())
+        h.update(np.ascontiguousarray(R, dtype=np.float64).tobytes())
+        h.update(source)
+        return h.hexdigest()
+
+    def load(self, key: str):
+        """ Load an entry, returns None if it does not exist. """
+        fname = os.path.join(self.path, key + ".npy")
+        if not os.path.exists(fname):
+            return None
+        return np.load(fname, mmap_mode="r")
+
+    def save(self, key: str, rho_g: np.ndarray):
+        """ Save an entry, written atomically so that concurrent runs can share the cache. """
+        with atomic_write(os.path.join(self.path, key + ".npy")) as f:
+            np.save(f, rho_g)
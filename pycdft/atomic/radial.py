@@ -0,0 +1,34 @@
+""" Radial Fourier transform of spherically averaged atomic densities. """
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+from pycdft.atomic import rd_grid, drd
+
+
+class RadialTransform:
+    r""" Fourier transform of spherical functions defined on the radial grid rd_grid.
+
+    :math:`\rho(G) = 4 \pi \int \rho(r) r \sin(Gr) / G dr` is evaluated with the rectangle
+    rule on a uniform table of :math:`|G|` spanning [0, Gmax], then interpolated onto any
+    set of :math:`|G|` by cubic splines. Memory is set by the table size and does not depend
+    on the number of distinct :math:`|G|` on the FFT grid.
+
+    For the densities in atomic/rho and the default dG = 0.01 bohr^-1, the interpolation
+    error is below 1e-8 * nel for all species.
+
+    Attributes:
+        G_t (np.ndarray): uniform |G| table.
+        kernel (np.ndarray, shape = [len(rd_grid), len(G_t)]): :math:`4 \pi dr r \sin(Gr) / G`.
+    """
+
+    def __init__(self, Gmax: float, dG: float = 0.01):
+        # pad the table by a few points so that Gmax is not at the edge of the spline
+        self.G_t = dG * np.arange(int(np.ceil(Gmax / dG)) + 4)
+        self.kernel = 4 * np.pi * drd * rd_grid[:, np.newaxis] ** 2 * np.sinc(
+            np.outer(rd_grid, self.G_t) / np.pi
+        )
+
+    def __call__(self, rho_rd: np.ndarray, G: np.ndarray):
+        """ Compute rho(|G|) for radial density rho_rd at given norms G. """
+        assert np.max(G) <= self.G_t[-1]
+        return CubicSpline(self.G_t, rho_rd @ self.kernel)(G)
@@ -6,8 +6,12 @@ import time
 import sys
 import io
 import base64
+import pickle
 import scipy.optimize
 from pycdft.common import Sample, timer
+from pycdft.common.fileio import atomic_write
+from pycdft.common.memo import EvaluationCache
+from pycdft.common.parallel import AtomExecutor
 from pycdft.constraint import Constraint
 from pycdft.dft_driver import DFTDriver
 
@@ -26,10 +30,43 @@ class CDFTSolver:
         sample (:class:`Sample`): the whole system for which CDFT calculation is performed.
         constraints (list of :class:`Constraint`): constraints on the system.
         dft_driver (:class:`DFTDriver`): the interface to DFT code (e.g., Qbox or PWscf).
-        optimizer (str): optimization strategy for constrained Hamiltonian, default = "secant"
+        optimizer (str): optimization strategy for constrained Hamiltonian, default = "secant".
+            "broyden" solves N = N0 for any number of constraints, see solve_broyden.
+            "anderson-bjorck" is a safeguarded secant method for one constraint, see
+            solve_anderson_bjorck.
         maxcscf (int): maximum number of CDFT iterations, default =1000.
         maxstep (int): maximum geometry optimization steps, default = 100.
         F_tol (float): force threshold for optimization, default = 1e-02.
+        force_workers (int): number of workers for constraint forces, default = 1.
+        force_executor (str): "thread" or "process" workers for constraint forces,
+            default = "thread".
+        force_pool (AtomExecutor): workers for constraint forces, kept for all geometry
+            steps and shut down at the end of solve.
+        jacobian (np.ndarray, shape = [k, k]): dN/dV for k constraints, kept by the
+            "broyden" and "anderson-bjorck" optimizers across geometry steps.
+        jacobian_file (str): file the Jacobian is saved to after every update; it is
+            loaded from this file, if it exists, at the first geometry step, so a
+            restarted job reuses the Jacobian of the previous run. Default =
+            jacobian<i>.npy for the i-th solver in ./pycdft_outputs, outside the output
+            folder of the solver. There is no default with lrestart = True.
+        fd_step (float): step of V for finite difference seeding of the Jacobian,
+            default = 0.05.
+        max_dV (float): maximum change of any V in one Broyden step, and in the first
+            step of the "anderson-bjorck" optimizer, default = 1.0.
+        scf_tol (2-tuple of float): (tight, loose) tolerance of inner SCF calculations, see
+            get_scf_tol; default = None, the DFT driver uses its own settings.
+        memo (EvaluationCache): DFT results of earlier CDFT iterations, enabled by the
+            memo_dir argument (e.g. "./pycdft_outputs/memo"). An iteration with the same
+            structure and V (within 1e-6) as a stored one reuses its Ed, Ec, N and charge
+            density instead of running DFT, also across restarted jobs. The converged
+            iteration is always computed, so that the DFT code holds its solution.
+        checkpoint (bool): if True (default), a checkpoint is written to checkpoint_file at
+            the beginning of every geometry step and after every CDFT iteration, see
+            write_checkpoint and resume. The DFT code only saves its state (wavefunction)
+            at the beginning of every geometry step.
+        checkpoint_file (str): default = checkpoint<i>.pkl for the i-th solver in
+            ./pycdft_outputs, outside the output folder of the solver, which is emptied
+            when a solver is created. There is no default with lrestart = True.
 
     Internal Parameters:
         Vc_tot (float array, shape == [vspin, n1, n2, n3]): total constraint potential
@@ -40,7 +77,11 @@ class CDFTSolver:
 
     def __init__(self, job: str, sample: Sample, dft_driver: DFTDriver,
                  optimizer: str = "secant", maxcscf: int = 1000, maxstep: int = 100,
-                 F_tol: float = 1.0E-2, lrestart: bool=False):
+                 F_tol: float = 1.0E-2, lrestart: bool=False,
+                 force_workers: int = 1, force_executor: str = "thread",
+                 jacobian_file: str = None, fd_step: float = 0.05, max_dV: float = 1.0,
+                 scf_tol: tuple = None, memo_dir: str = None,
+                 checkpoint: bool = True, checkpoint_file: str = None):
 
         self.job = job
         self.sample = sample
@@ -54,6 +95,25 @@ class CDFTSolver:
         self.itscf = None
         self.start_time = time.time()
         self.lrestart = lrestart
+        self.force_workers = force_workers
+        self.force_executor = force_executor
+        self.force_pool = AtomExecutor(force_workers, force_executor)
+        self.jacobian = None
+        self.jacobian_file = jacobian_file
+        self.fd_step = fd_step
+        self.max_dV = max_dV
+        self.scf_tol = scf_tol
+        self.residual = None
+        self.memo = EvaluationCache(memo_dir) if memo_dir is not None else None
+        self.memo_key = None
+        self.checkpoint = checkpoint
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_wfc = None
+        self.istep = 1
+        self.step_start = None
+        self.history = []
+        self.replay = []
+        self.jacobian_read = False
 
         if not self.lrestart:
            # make output folder, keeping any previous runs
@@ -66,6 +126,12 @@ class CDFTSolver:
            else:
                os.makedirs(self.output_path)
            self.dft_driver.reset(self.output_path)
+           if self.jacobian_file is None:
+               self.jacobian_file = "./pycdft_outputs/jacobian{}.npy".format(self.isolver)
+           if self.checkpoint_file is None:
+               self.checkpoint_file = "./pycdft_outputs/checkpoint{}.pkl".format(self.isolver)
+        if self.checkpoint and self.checkpoint_file is None:
+            print("CDFTSolver: lrestart = True and no checkpoint_file, checkpoints are disabled")
 
     def solve(self):
         """ Solve CDFT SCF or optimization problem."""
@@ -84,6 +150,8 @@ class CDFTSolver:
             print(sys.exc_info())
             print("Terminating DFT driver...")
             self.dft_driver.exit() 
+        finally:
+            self.force_pool.close()
 
     def solve_scf(self):
         """ Iteratively solve the CDFT problem.
@@ -95,6 +163,8 @@ class CDFTSolver:
         Internal Parameters:
              secant: requires V_init
              bisect, brentq, brenth: requires V_brak
+             anderson-bjorck: requires V_init; V_brak sets the first step if given
+             broyden, BFGS: require V_init, any number of constraints
 
         Note:
              For methods requiring V_brak = [a,b], the objective function f must be continuous
@@ -104,11 +174,24 @@ class CDFTSolver:
         """
 
         self.sample.update_weights()
+        self.residual = None
+        if self.memo is not None:
+            self.memo_key = self.memo.key(self.sample)
 
-        if self.optimizer in ["secant", "bisect", "brentq", "brenth"]:
+        if self.optimizer in ["secant", "anderson-bjorck", "bisect", "brentq", "brenth"]:
             assert len(self.constraints) == 1
 
         self.itscf = 0
+        if self.optimizer in ["broyden", "anderson-bjorck"]:
+            self.load_jacobian()
+        self.step_start = dict(
+            coords=np.array([atom.abs_coord for atom in self.sample.atoms]),
+            V_init=[c.V_init for c in self.constraints],
+            jacobian=self.jacobian,
+        )
+        self.history = []
+        if not self.replay:
+            self.write_checkpoint()
 
         try:
             if self.optimizer == "secant":
@@ -138,6 +221,10 @@ class CDFTSolver:
                     b=self.constraints[0].V_brak[1],
                     maxiter=self.maxcscf
                 )
+            elif self.optimizer == "anderson-bjorck":
+                self.solve_anderson_bjorck()
+            elif self.optimizer == "broyden":
+                self.solve_broyden()
             elif self.optimizer in ["BFGS"]:
                 res = scipy.optimize.minimize(
                     method=self.optimizer,
@@ -165,25 +252,67 @@ class CDFTSolver:
         # Update constraints
         for c, V in zip(self.constraints, Vs):
             c.V = V
-            c.update_Vc()
 
         # Compute the total constraint potential Vc.
-        self.Vc_tot = np.sum(c.Vc for c in self.constraints)
+        self.Vc_tot = Constraint.compute_Vc_tot(self.constraints)
 
-        # Impose the constraint potential Vc to DFT code.
-        self.dft_driver.set_Vc(self.Vc_tot)
-
-        # Order DFT code to perform SCF calculation under the constraint potential Vc.
-        # After dft driver run_scf command should read etotal and force
         start_dft = time.time()
-        self.dft_driver.run_scf()
-        self.dft_driver.get_rho_r()
+        scf_tol = self.get_scf_tol()
+
+        # Reuse DFT results of an iteration replayed from a checkpoint or of an earlier
+        # iteration with the same V, unless converged
+        entry = None
+        if self.replay:
+            entry = self.replay.pop(0)
+            if entry["V"].shape != np.shape(Vs) or np.max(np.abs(entry["V"] - Vs)) > 1.0E-8:
+                print("V differs from the checkpoint, stop replaying")
+                self.replay = []
+                entry = None
+        if entry is None and self.memo is not None:
+            entry = self.memo.lookup(self.memo_key, Vs, scf_tol)
+        if entry is not None:
+            for c, N in zip(self.constraints, entry["N"]):
+                c.N = N
+            if self.is_converged(scf_tol):
+                entry = None
+
+        if entry is not None:
+            if "rho_r" in entry:
+                print("Reusing DFT results from {}".format(self.memo.path))
+                self.sample.rho_r = entry["rho_r"].astype(self.sample.rdtype, copy=False)
+            else:
+                print("Reusing DFT results from {}".format(self.checkpoint_file))
+            self.sample.Ed = entry["Ed"]
+            self.sample.Ec = entry["Ec"]
+        else:
+            # Impose the constraint potential Vc to DFT code.
+            self.dft_driver.set_Vc(self.Vc_tot)
+
+            # Order DFT code to perform SCF calculation under the constraint potential Vc.
+            # After dft driver run_scf command should read etotal and force
+            if scf_tol is None:
+                self.dft_driver.run_scf()
+            else:
+                print("Inner SCF tolerance: {:.2E}".format(scf_tol))
+                self.dft_driver.run_scf(scf_tol=scf_tol)
+            self.dft_driver.get_rho_r()
+
+            Constraint.update_N_all(self.constraints)
+            if self.memo is not None:
+                self.memo.store(self.memo_key, Vs, scf_tol, self.sample.Ed, self.sample.Ec,
+                                [c.N for c in self.constraints], self.sample.rho_r)
         end_dft = time.time()
 
-        for i, c in enumerate(self.constraints):
-            c.update_N()
+        self.residual = max(abs(c.dW_by_dV) / c.N_tol for c in self.constraints)
         self.sample.W = self.sample.Ed + self.sample.Ec - np.sum(c.N * c.V for c in self.constraints)
 
+        self.history.append(dict(
+            V=np.array(Vs, dtype=np.float64), N=np.array([c.N for c in self.constraints]),
+            Ed=self.sample.Ed, Ec=self.sample.Ec, scf_tol=scf_tol,
+        ))
+        if not self.replay:
+            self.write_checkpoint(save_dft=False)
+
         # Print intermediate results
         print("=======================================")
         print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
@@ -205,12 +334,186 @@ class CDFTSolver:
         print("Elapsed time: ")
         timer(self.start_time, time.time())
 
-        if all(c.is_converged for c in self.constraints):
+        if self.is_converged(scf_tol):
             raise CDFTSCFConverged
 
         # return the negative of W and dW/dV to be used by scipy minimizers
         return -self.sample.W, np.array(list(-c.dW_by_dV for c in self.constraints))
 
+    def is_converged(self, scf_tol=None):
+        """ Whether all constraints are converged after an SCF with tolerance scf_tol. """
+        # N from a loosely converged SCF is not trusted for convergence
+        return all(c.is_converged for c in self.constraints) \
+            and (scf_tol is None or scf_tol <= self.scf_tol[0])
+
+    def get_scf_tol(self):
+        """ Tolerance of the next inner SCF calculation.
+
+        The tolerance follows the residual of the last CDFT iteration, max |N - N0| / N_tol
+        over constraints: it is tight * residual, bounded by (tight, loose) = scf_tol, so
+        inner SCF calculations are loose far from the solution and tight near it. The first
+        iteration of each geometry step uses loose.
+        """
+        if self.scf_tol is None:
+            return None
+        tight, loose = self.scf_tol
+        if self.residual is None:
+            return loose
+        return float(np.clip(tight * self.residual, tight, loose))
+
+    def solve_broyden(self):
+        """ Solve N = N0 for all constraints with Broyden's method.
+
+        The Jacobian J = dN/dV is taken from the previous geometry step or from
+        jacobian_file, or seeded by forward finite differences (one extra SCF per
+        constraint). After every step J is corrected by Broyden's rank-one update, and
+        the last J is kept for the next geometry step. Steps are scaled so that no V
+        changes by more than max_dV.
+        """
+        k = len(self.constraints)
+
+        def residual(V):
+            converged = False
+            try:
+                self.solve_scf_with_new_V(V)
+            except CDFTSCFConverged:
+                converged = True
+            return np.array([c.dW_by_dV for c in self.constraints]), converged
+
+        self.load_jacobian()
+        V = np.array([c.V_init for c in self.constraints], dtype=float)
+        try:
+            F, converged = residual(V)
+            if converged:
+                raise CDFTSCFConverged
+
+            if self.jacobian is None:
+                J = np.zeros([k, k])
+                for i in range(k):
+                    dV = np.zeros(k)
+                    dV[i] = self.fd_step
+                    Fi, converged = residual(V + dV)
+                    if converged:
+                        raise CDFTSCFConverged
+                    J[:, i] = (Fi - F) / self.fd_step
+                self.save_jacobian(J)
+
+            while self.itscf < self.maxcscf:
+                J = self.jacobian
+                try:
+                    dV = - np.linalg.solve(J, F)
+                except np.linalg.LinAlgError:
+                    dV = - np.linalg.lstsq(J, F, rcond=None)[0]
+                step = np.max(np.abs(dV))
+                if step == 0.0:
+                    break
+                if step > self.max_dV:
+                    dV *= self.max_dV / step
+
+                F_new, converged = residual(V + dV)
+                self.save_jacobian(J + np.outer(F_new - F - J @ dV, dV) / (dV @ dV))
+                V, F = V + dV, F_new
+                if converged:
+                    raise CDFTSCFConverged
+        finally:
+            # start from the last V in the next geometry step
+            for c in self.constraints:
+                c.V_init = c.V
+
+    def solve_anderson_bjorck(self, expand=4.0):
+        """ Solve N = N0 for one constraint with a safeguarded secant method.
+
+        Starting from V_init, the root is first bracketed: the first step follows the slope
+        dN/dV of the previous geometry step if known, otherwise it goes in the direction
+        that reduces |N - N0| (dN/dV < 0) by a quarter of the width of V_brak, and is at
+        most max_dV. Further steps go in the same direction and are as long as the secant
+        step through the last two points, but at least as long as the last step and at
+        most expand times longer or max_dV. Once N - N0 changes sign, the bracket is
+        reduced with the Anderson-Bjorck variant of regula falsi, which converges
+        superlinearly and never leaves the bracket.
+
+        Args:
+            expand (float): maximum growth of the step while bracketing.
+        """
+        c = self.constraints[0]
+        history = []
+        self.load_jacobian()
+
+        def f(V):
+            try:
+                self.solve_scf_with_new_V([V])
+            finally:
+                history.append((V, c.dW_by_dV))
+            return history[-1][1]
+
+        try:
+            a = c.V_init
+            fa = f(a)
+            J = self.jacobian
+            if J is not None and J.shape == (1, 1) and J[0, 0] < 0:
+                dV = - fa / J[0, 0]
+            else:
+                width = c.V_brak[1] - c.V_brak[0] if c.V_brak is not None else 2.0
+                dV = np.sign(fa) * 0.25 * width
+            b = a + np.clip(dV, -self.max_dV, self.max_dV)
+            fb = f(b)
+
+            # bracket the root, moving in the direction of decreasing |N - N0| for dN/dV < 0;
+            # the secant step is used if it is longer than the last step. N(V) is monotonic,
+            # so |N - N0| only increases through SCF noise; close to the root, step back
+            f0 = fa
+            while fa * fb > 0:
+                if self.itscf >= self.maxcscf:
+                    return
+                if abs(fb) > abs(fa) and abs(fa) < 0.1 * abs(f0):
+                    x = 0.5 * (a + b)
+                else:
+                    slope = (fb - fa) / (b - a)
+                    step = - fb / slope if slope < 0 else np.inf
+                    step = np.clip(abs(step), abs(b - a), min(expand * abs(b - a), self.max_dV))
+                    x = b + np.sign(fb) * step
+                    a, fa = b, fb
+                b, fb = x, f(x)
+
+            # Anderson-Bjorck iterations on the bracket [a, b]
+            while self.itscf < self.maxcscf:
+                x = b - fb * (b - a) / (fb - fa)
+                if not min(a, b) < x < max(a, b):
+                    x = 0.5 * (a + b)
+                fx = f(x)
+                if fx * fb < 0:
+                    a, fa = b, fb
+                else:
+                    m = 1 - fx / fb
+                    fa *= m if m > 0 else 0.5
+                b, fb = x, fx
+        finally:
+            # start from the last V and slope in the next geometry step
+            c.V_init = c.V
+            if len(history) >= 2:
+                (V0, f0), (V1, f1) = history[-2:]
+                if V1 != V0 and (f1 - f0) / (V1 - V0) < 0:
+                    self.save_jacobian(np.array([[(f1 - f0) / (V1 - V0)]]))
+
+    def load_jacobian(self):
+        """ Load the Jacobian from jacobian_file if none is known yet, once per run. """
+        k = len(self.constraints)
+        if self.jacobian_read:
+            return
+        self.jacobian_read = True
+        if self.jacobian is None and self.jacobian_file is not None \
+                and os.path.exists(self.jacobian_file):
+            J = np.load(self.jacobian_file)
+            if J.shape == (k, k):
+                print("Reading Jacobian from {}".format(self.jacobian_file))
+                self.jacobian = J
+
+    def save_jacobian(self, J):
+        """ Keep the Jacobian of the "broyden" optimizer and save it to jacobian_file. """
+        self.jacobian = J
+        if self.jacobian_file is not None:
+            np.save(self.jacobian_file, J)
+
     def solve_scf_for_dW_by_dV(self, V):
         """ Wrapper function for solve_scf_with_new_V returning dW/dV."""
         return self.solve_scf_with_new_V([V])[1][0]
@@ -221,7 +524,8 @@ class CDFTSolver:
         A force from constraint potential is added to DFT force during optimization.
         """
 
-        for istep in range(1, self.maxstep + 1):
+        for istep in range(self.istep, self.maxstep + 1):
+            self.istep = istep
             print("======================================")
             print("Geometry optimization step {}".format(istep))
             print("======================================")
@@ -232,15 +536,20 @@ class CDFTSolver:
             # get DFT force
             self.dft_driver.get_force()
 
-            # compute constraint force
-            for c in self.constraints:
-                c.update_Fc()
+            # compute constraint force of all constraints in one pass over atoms
+            Constraint.update_Fc_all(self.constraints, pool=self.force_pool)
             self.sample.Fc = np.sum(c.Fc for c in self.constraints)
 
             self.sample.Fw = self.sample.Fd + self.sample.Fc
-            Fwnorm = np.linalg.norm(self.sample.Fw, axis=1)
+            # frozen atoms are kept fixed by the DFT driver (see set_Fc), only forces on
+            # mobile atoms matter
+            mobile = self.sample.mobile
+            if len(mobile) == 0:
+                print("\n**All atoms are frozen, constrained optimization converged!**\n")
+                break
+            Fwnorm =np.linalg.norm(self.sample.Fw[mobile], axis=1)
             maxforce = np.max(Fwnorm)
-            imaxforce = np.argmax(Fwnorm)
+            imaxforce = mobile[np.argmax(Fwnorm)]
             print("Maximum force = {:.6f} au, on {}th atom ({}).  Fw = {:.6f}, {:.6f}, {:.6f}".format(
                 maxforce, imaxforce+1, self.sample.atoms[imaxforce].symbol, *self.sample.Fw[imaxforce]
             ))
@@ -249,8 +558,8 @@ class CDFTSolver:
                 *self.sample.Fd[imaxforce], *self.sample.Fc[imaxforce]
             ))
  
-            # print all forces
-            for i in np.arange(len(self.sample.atoms)):
+            # print forces on all mobile atoms
+            for i in mobile:
                 print("{}th atom ({})  Fd = {:.6f}, {:.6f}, {:.6f}; Fc = {:.6f}, {:.6f}, {:.6f}".format(
                  i + 1, self.sample.atoms[i].symbol, *self.sample.Fd[i], *self.sample.Fc[i]
                 ))
@@ -264,19 +573,38 @@ class CDFTSolver:
             # run optimization
             self.dft_driver.run_opt()
 
-            # parse updated coordinates
+            # parse updated coordinates; weights are updated for the new structure
+            # at the beginning of solve_scf
             self.dft_driver.get_structure()
 
-            # update weights and constraint potentials
-            for c in self.constraints:
-                c.update_structure()
-
         else:
             print("\n**Constrained optimization NOT achieved after {} steps!**\n".format(self.maxstep))
 
     def copy(self):
-        """ Generate a deepcopy of the current CDFTSolver instance."""
-        return deepcopy(self)
+        """ Generate a deepcopy of the current CDFTSolver instance.
+
+        Unless lrestart is set, the copy is a new solver with its own output folder; its
+        Jacobian and checkpoint files default to its own as well, unless they were set
+        explicitly. Checkpoint and replay state of the current run are not copied.
+        """
+        solver = deepcopy(self)
+        if not self.lrestart:
+            CDFTSolver.nsolver += 1
+            solver.isolver = CDFTSolver.nsolver
+            solver.output_path = "./pycdft_outputs/solver{}/".format(solver.isolver)
+            if os.path.exists(solver.output_path):
+                shutil.rmtree(solver.output_path)
+            os.makedirs(solver.output_path)
+            solver.dft_driver.output_path = solver.output_path
+            if self.jacobian_file == "./pycdft_outputs/jacobian{}.npy".format(self.isolver):
+                solver.jacobian_file = "./pycdft_outputs/jacobian{}.npy".format(solver.isolver)
+            if self.checkpoint_file == "./pycdft_outputs/checkpoint{}.pkl".format(self.isolver):
+                solver.checkpoint_file = "./pycdft_outputs/checkpoint{}.pkl".format(solver.isolver)
+        solver.checkpoint_wfc = None
+        solver.step_start = None
+        solver.history = []
+        solver.replay = []
+        return solver
 
     def restart(self, wfcfile, dft_energies):
         """ Restart from previous CDFT run.
@@ -296,6 +624,88 @@ class CDFTSolver:
             print("Quitting DFT driver")
             self.dft_driver.exit()
 
+    def write_checkpoint(self, save_dft=True):
+        """ Write a checkpoint to checkpoint_file, replacing it atomically.
+
+        The checkpoint holds the geometry step, the structure, V_init and Jacobian at the
+        beginning of the step, V, N, Ed and Ec of all CDFT iterations of the step so far,
+        the current Vc_tot and the name of the file the DFT code saved its state to.
+
+        Args:
+            save_dft (bool): whether the DFT code saves its state (atoms and wavefunction)
+                             first, needed whenever atoms moved; files alternate, so the
+                             last complete one is kept.
+        """
+        if not self.checkpoint or self.checkpoint_file is None:
+            return
+        root = os.path.splitext(self.checkpoint_file)[0]
+        if save_dft or self.checkpoint_wfc is None:
+            wfc_file = "{}-wfc{}.xml".format(root, 1 if self.checkpoint_wfc == root + "-wfc0.xml" else 0)
+            self.dft_driver.save_state(wfc_file)
+            self.checkpoint_wfc = wfc_file
+
+        state = dict(
+            job=self.job,
+            optimizer=self.optimizer,
+            istep=self.istep,
+            step_start=self.step_start,
+            history=self.history,
+            Vc_tot=None if self.Vc_tot is None else np.ascontiguousarray(self.Vc_tot),
+            wfc_file=self.checkpoint_wfc,
+            driver_step=(self.dft_driver.istep, self.dft_driver.icscf),
+        )
+        with atomic_write(self.checkpoint_file) as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def resume(self, path):
+        """ Resume a run from a checkpoint written by write_checkpoint and finish it.
+
+        The solver must be set up as in the interrupted run (job, optimizer, sample and
+        constraints). The DFT code loads the state saved at the beginning of the interrupted
+        geometry step, the structure, V_init and Jacobian of the step are restored, and the
+        step is run again: the optimizer takes the same path, and the CDFT iterations
+        finished before the interruption reuse the recorded N, Ed and Ec instead of running
+        DFT. The last of them is only computed again if it was converged.
+
+        Args:
+            path (str): checkpoint file, e.g. ./pycdft_outputs/checkpoint1.pkl.
+        """
+        print("=================== Resuming run =======================")
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        step_start = state["step_start"]
+        if state["job"] != self.job or state["optimizer"] != self.optimizer:
+            raise ValueError("Checkpoint of a {} run with optimizer {}".format(
+                state["job"], state["optimizer"]))
+        if len(step_start["coords"]) != self.sample.natoms \
+                or len(step_start["V_init"]) != len(self.constraints):
+            raise ValueError("Checkpoint of a different sample or constraints")
+
+        for atom, coord in zip(self.sample.atoms, step_start["coords"]):
+            atom.abs_coord = coord.copy()
+        for c, V_init in zip(self.constraints, step_start["V_init"]):
+            c.V_init = V_init
+        self.jacobian = step_start["jacobian"]
+        self.jacobian_read = True
+        self.istep = state["istep"]
+        self.replay = list(state["history"])
+        self.Vc_tot = state["Vc_tot"]
+        self.checkpoint_wfc = state["wfc_file"]
+        print("Geometry step {}, {} CDFT iterations done".format(self.istep, len(self.replay)))
+
+        try:
+            self.dft_driver.load_state(self.checkpoint_wfc)
+            self.dft_driver.istep, self.dft_driver.icscf = state["driver_step"]
+        except:
+            print(" Resume failed! ")
+            e = sys.exc_info()
+            print(e)
+            print("Quitting DFT driver")
+            self.dft_driver.exit()
+            return
+
+        self.solve()
+
     def get_Vc(self, Vc_file):
         """ Read Vc in cube format from Qbox; for restarting calculations for elcoupling"""
         sample = self.dft_driver.sample
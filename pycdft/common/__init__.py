@@ -1,5 +1,5 @@
 from .sample import Sample
-from .ft import FFTGrid
+from .ft import FFTGrid, FFTEngine
 from .fragment import Fragment
 
 
@@ -0,0 +1,26 @@
+""" Helpers for files shared between runs. """
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(fname: str):
+    """ Open a temporary binary file that replaces fname when the context exits normally.
+
+    The temporary file is created in the directory of fname, so the replacement is atomic:
+    readers, including concurrent runs sharing a cache and jobs restarted after being
+    killed, see either the old file or the complete new one.
+    """
+    dirname = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmpname, fname)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
@@ -20,3 +20,7 @@ class Fragment(object):
         self.natoms = len(self.atoms)
         self.rhopro_r = None
         self.sample.fragments.append(self)
+
+    def freeze(self, frozen: bool = True):
+        """ Freeze (or unfreeze) all atoms of the fragment. """
+        self.sample.freeze(self.atoms, frozen)
@@ -5,22 +5,168 @@
         f(r) = sigma{ f(G) exp(iGr) }
 """
 
+import os
+import atexit
+import pickle
+import threading
 import numpy as np
+import scipy.fft
 
 try:
-    from pyfftw.interfaces.numpy_fft import fftn, ifftn, rfftn, irfftn
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
 except ImportError:
-    from numpy.fft import fftn, ifftn, rfftn, irfftn
+    pyfftw = None
 from numpy.fft import fftshift, ifftshift
+from contextlib import contextmanager
+from pycdft.common.fileio import atomic_write
+
+_workers_limit = None
+
+
+@contextmanager
+def fft_workers_limit(n):
+    """Limit the number of threads per FFT of all FFT engines to n within the context."""
+    global _workers_limit
+    old, _workers_limit = _workers_limit, n
+    try:
+        yield
+    finally:
+        _workers_limit = old
+
+
+class FFTEngine:
+    def __init__(self, workers=None, wisdom_file=None, planner_effort=None,
+                 use_pyfftw=True):
+        """Backend for all FFTs on FFT grids.
+
+        With pyFFTW, the interface cache is enabled so that FFTW plans are reused across
+        calls, inputs are copied into preallocated SIMD-aligned buffers (one per shape and
+        dtype), and FFTW wisdom is loaded from and saved to wisdom_file so that restarted
+        runs skip planning. Without pyFFTW, scipy.fft is used with the same worker count.
+
+        Args:
+            workers (int): number of threads per FFT; default to the PYCDFT_FFT_WORKERS
+                environment variable or 1.
+            wisdom_file (str): file for FFTW wisdom, default to the PYCDFT_FFTW_WISDOM
+                environment variable; wisdom is saved at exit.
+            planner_effort (str): FFTW planner flag; default to FFTW_MEASURE if a wisdom
+                file is used, so that planning is paid once, otherwise FFTW_ESTIMATE.
+            use_pyfftw (bool): if False, always use scipy.fft.
+        """
+        if workers is None:
+            workers = int(os.environ.get("PYCDFT_FFT_WORKERS", 1))
+        if wisdom_file is None:
+            wisdom_file = os.environ.get("PYCDFT_FFTW_WISDOM")
+        self.workers = workers
+        if planner_effort is None:
+            planner_effort = "FFTW_MEASURE" if wisdom_file is not None else "FFTW_ESTIMATE"
+        self.wisdom_file = wisdom_file
+        self.planner_effort = planner_effort
+        self.use_pyfftw = use_pyfftw and pyfftw is not None
+        self._local = threading.local()
+
+        if self.use_pyfftw:
+            pyfftw.interfaces.cache.enable()
+            # keep plans alive between SCF iterations
+            pyfftw.interfaces.cache.set_keepalive_time(3600)
+            if self.wisdom_file is not None:
+                self.load_wisdom()
+                atexit.register(self.save_wisdom)
+
+    @property
+    def threads(self):
+        """Number of threads per FFT, workers bounded by fft_workers_limit."""
+        if _workers_limit is None:
+            return self.workers
+        return min(self.workers, _workers_limit)
+
+    def load_wisdom(self):
+        """Import FFTW wisdom from wisdom_file if it exists."""
+        if self.use_pyfftw and self.wisdom_file and os.path.exists(self.wisdom_file):
+            with open(self.wisdom_file, "rb") as f:
+                pyfftw.import_wisdom(pickle.load(f))
+
+    def save_wisdom(self):
+        """Export FFTW wisdom to wisdom_file."""
+        if not (self.use_pyfftw and self.wisdom_file):
+            return
+        with atomic_write(self.wisdom_file) as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+
+    def aligned(self, a):
+        """Copy a into the preallocated aligned buffer of its shape and dtype."""
+        # buffers are per thread, so that FFTs can run concurrently
+        buffers = self._local.__dict__.setdefault("buffers", {})
+        key = (a.shape, a.dtype.str)
+        if key not in buffers:
+            buffers[key] = pyfftw.empty_aligned(a.shape, dtype=a.dtype)
+        buf = buffers[key]
+        np.copyto(buf, a)
+        return buf
+
+    def _pyfftw(self, func, a, **kwargs):
+        # the aligned buffer is scratch space, FFTW may overwrite it
+        return func(self.aligned(a), overwrite_input=True, threads=self.threads,
+                    planner_effort=self.planner_effort, **kwargs)
+
+    def fftn(self, a, axes=None):
+        if self.use_pyfftw:
+            return self._pyfftw(pyfftw.interfaces.numpy_fft.fftn, a, axes=axes)
+        return scipy.fft.fftn(a, axes=axes, workers=self.threads)
+
+    def ifftn(self, a, axes=None):
+        if self.use_pyfftw:
+            return self._pyfftw(pyfftw.interfaces.numpy_fft.ifftn, a, axes=axes)
+        return scipy.fft.ifftn(a, axes=axes, workers=self.threads)
+
+    def rfftn(self, a, axes=None):
+        if self.use_pyfftw:
+            return self._pyfftw(pyfftw.interfaces.numpy_fft.rfftn, a, axes=axes)
+        return scipy.fft.rfftn(a, axes=axes, workers=self.threads)
+
+    def irfftn(self, a, s=None, axes=None):
+        if self.use_pyfftw:
+            return self._pyfftw(pyfftw.interfaces.numpy_fft.irfftn, a, s=s, axes=axes)
+        return scipy.fft.irfftn(a, s=s, axes=axes, workers=self.threads)
+
+    def __getstate__(self):
+        # buffers are scratch space
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+
+_default_engine = None
+
+
+def get_default_engine():
+    """Get the FFT engine shared by all grids that are not given one explicitly."""
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = FFTEngine()
+    return _default_engine
+
+
+def set_default_engine(engine):
+    """Set the FFT engine shared by all grids created afterwards."""
+    global _default_engine
+    _default_engine = engine
 
 
 class FFTGrid:
-    def __init__(self, n1, n2, n3):
+    def __init__(self, n1, n2, n3, engine=None):
         """Grid for FFT.
 
         Args:
             n1, n2, n3 (int): FFT grid size (same for R and G space)
+            engine (FFTEngine): FFT backend, default to the shared default engine.
         """
+        self.engine = engine if engine is not None else get_default_engine()
         self.n1 = n1
         self.n2 = n2
         self.n3 = n3
@@ -30,12 +176,238 @@ class FFTGrid:
         self.n1h = self.n1 // 2 + 1
         self.n2h = self.n2 // 2 + 1
         self.n3h = self.n3 // 2 + 1
-        full_grid = np.zeros((self.n1, self.n2, self.n3))
-        full_grid[self.n1h:, :, :] = 1
-        full_grid[0, self.n2h:, :] = 1
-        full_grid[0, 0, self.n3h:] = 1
-        self.yzlowerplane = zip(*np.nonzero(full_grid[0, ...]))
-        self.xyzlowerspace = zip(*np.nonzero(full_grid))
+        self._yzlowerplane = None
+        self._xyzlowerspace = None
+
+    @property
+    def yzlowerplane(self):
+        """Flat indices of the lower half of the iG1 = 0 plane, and of their mirrors.
+
+        Returns:
+            2-tuple of index arrays into the raveled [n2, n3] plane: lower points and
+            mirror points (-ig2, -ig3).
+        """
+        if self._yzlowerplane is None:
+            lower = np.zeros((self.n2, self.n3), dtype=bool)
+            lower[self.n2h:, :] = True
+            lower[0, self.n3h:] = True
+            self._yzlowerplane = self._flat_mirror(lower)
+        return self._yzlowerplane
+
+    @property
+    def xyzlowerspace(self):
+        """Indices (ig1, ig2, ig3) of the lower half of G space, and of their mirrors.
+
+        Lower points are those excluded in the gamma-trick case, i.e. iG1 < 0, or
+        iG1 == 0 and iG2 < 0, or iG1 == iG2 == 0 and iG3 < 0. Mirrors of lower points are
+        never lower points.
+
+        Returns:
+            2-tuple of index arrays into the raveled [n1, n2, n3] grid: lower points and
+            mirror points.
+        """
+        if self._xyzlowerspace is None:
+            lower = np.zeros((self.n1, self.n2, self.n3), dtype=bool)
+            lower[self.n1h:, :, :] = True
+            lower[0, self.n2h:, :] = True
+            lower[0, 0, self.n3h:] = True
+            self._xyzlowerspace = self._flat_mirror(lower)
+        return self._xyzlowerspace
+
+    @staticmethod
+    def _flat_mirror(lower):
+        # one flat index array per side, int32 where possible, to keep the cache small
+        dtype = np.int32 if lower.size < 2 ** 31 else np.intp
+        idxs = np.nonzero(lower)
+        mirror = tuple((-idx) % n for idx, n in zip(idxs, lower.shape))
+        return (np.ravel_multi_index(idxs, lower.shape).astype(dtype),
+                np.ravel_multi_index(mirror, lower.shape).astype(dtype))
+
+
+class ReciprocalGrid:
+    def __init__(self, G, n1, n2, n3, real=False, engine=None):
+        """G vectors of an FFT grid, stored as separable 1D components.
+
+        A G vector on the grid is h * G[0] + k * G[1] + l * G[2] with integer frequencies
+        (h, k, l) in the order generated by fftfreq. Each Cartesian component of G is thus
+        a sum of three 1D arrays; those are kept instead of [n1, n2, n3] arrays, and full
+        grids of G components or |G|^2 are only built on demand (optionally for a slab of
+        the first axis to bound memory).
+
+        Args:
+            G (np.ndarray, shape = [3, 3]): reciprocal lattice vectors (one per row).
+            n1, n2, n3 (int): FFT grid size.
+            real (bool): if True, only iG1 >= 0 is kept (the half-spectrum of real functions,
+                see ftrg and ftgr), and the grid has the shape of (n1 // 2 + 1, n2, n3).
+            engine (FFTEngine): FFT backend, default to the shared default engine.
+
+        Attributes:
+            freqs (list of np.ndarray): integer frequencies along each axis.
+            Gs (list of np.ndarray, shape = [3, n_i]): Gs[i][a] is the Cartesian component a
+                of freqs[i] * G[i].
+        """
+        self.engine = engine if engine is not None else get_default_engine()
+        self.G = G
+        self.n1 = n1
+        self.n2 = n2
+        self.n3 = n3
+        self.N = n1 * n2 * n3
+        self.n1h = n1 // 2 + 1
+        self.real = real
+
+        self.freqs = [np.fft.fftfreq(m, d=1. / m) for m in (n1, n2, n3)]
+        if real:
+            # for even n1 the last plane holds iG1 = -n1 / 2, same as on the full grid
+            self.freqs[0] = self.freqs[0][:self.n1h]
+        self.Gs = [np.outer(G[i], self.freqs[i]) for i in range(3)]
+
+    @property
+    def shape(self):
+        return len(self.freqs[0]), self.n2, self.n3
+
+    def broadcast(self, a, sl=slice(None)):
+        """Terms of Cartesian component a of G, shaped for broadcasting to the grid.
+
+        Args:
+            a (int): Cartesian index (0, 1, 2 for x, y, z).
+            sl (slice): slab of the first axis.
+
+        Returns:
+            3-tuple of arrays of shape [m, 1, 1], [1, n2, 1], [1, 1, n3] whose sum is G_a.
+        """
+        G1s, G2s, G3s = self.Gs
+        return (G1s[a, sl, np.newaxis, np.newaxis],
+                G2s[a, np.newaxis, :, np.newaxis],
+                G3s[a, np.newaxis, np.newaxis, :])
+
+    def component(self, a, sl=slice(None)):
+        """Cartesian component a of G vectors on the grid (or a slab of it)."""
+        g1, g2, g3 = self.broadcast(a, sl)
+        return g1 + g2 + g3
+
+    def norm2(self, sl=slice(None)):
+        """|G|^2 on the grid (or a slab of it)."""
+        G2 = self.component(0, sl) ** 2
+        for a in (1, 2):
+            G2 += self.component(a, sl) ** 2
+        return G2
+
+    def shells(self, rtol=1e-12):
+        """Map all G vectors on the grid to shells of G vectors with the same norm.
+
+        |G|^2 values are sorted once; consecutive values differing by no more than
+        rtol * |G|^2 (i.e. equal up to floating point noise) are merged into one shell.
+        rtol = 0 only merges bitwise identical norms.
+
+        Returns:
+            Gmapping (np.ndarray, shape = self.shape): shell index of every G vector.
+            G_d (np.ndarray): norm of G vectors in each shell, in ascending order.
+        """
+        # |G|^2 is built slab by slab, so that only one grid of |G|^2 is allocated
+        G2 = np.empty(self.shape)
+        for sl in self.slabs():
+            G2[sl] = self.norm2(sl)
+        G2 = G2.ravel()
+        order = np.argsort(G2)
+        G2 = G2[order]
+
+        newshell = np.empty(G2.size, dtype=bool)
+        newshell[0] = True
+        np.greater(G2[1:] - G2[:-1], rtol * G2[1:], out=newshell[1:])
+
+        Gmapping = np.empty(G2.size, dtype=np.intp)
+        Gmapping[order] = np.cumsum(newshell) - 1
+        G_d = np.sqrt(G2[newshell])
+        return Gmapping.reshape(self.shape), G_d
+
+    def slabs(self, maxpoints=2 ** 22):
+        """Split the first axis into slabs containing at most maxpoints grid points."""
+        m = self.shape[0]
+        step = max(1, maxpoints // (self.n2 * self.n3))
+        return [slice(i, min(i + step, m)) for i in range(0, m, step)]
+
+
+class FourierResampler:
+    def __init__(self, m, n):
+        """Fourier interpolation between two FFT grid sizes.
+
+        Along each axis, the G vectors kept when cropping (or the positions filled when
+        padding) are those of the centered (fftshift) ordering. They are computed once as
+        index maps from dest to source in fftfreq order, so resampling is a single gather
+        with no shifted copies. Axes may be cropped, padded or left unchanged independently.
+
+        Only index maps are kept; FFTs in resample_r use the engines of the grids passed
+        by the caller. Use get_resampler to reuse resamplers across calls.
+
+        Args:
+            m (3-tuple of int): size of the FFT grid on which input functions are defined.
+            n (3-tuple of int): size of the FFT grid on which output functions are defined.
+        """
+        self.m = m = tuple(m)
+        self.n = n = tuple(n)
+
+        # maps[i][p] is the source index of dest index p along axis i, -1 if not in source
+        maps = [self._axis_map(m[i], n[i]) for i in range(3)]
+        self.idxs = [self._gather(maps[i]) for i in range(3)]
+
+        # half-spectrum of real functions: iG1 = 0 ... n1 // 2 along the first axis
+        half_map = np.arange(n[0] // 2 + 1)
+        half_map[half_map > m[0] // 2] = -1
+        self.idxs_real = [self._gather(half_map)] + self.idxs[1:]
+
+    @staticmethod
+    def _axis_map(m, n):
+        src = np.arange(m)
+        d = m - n
+        if d > 0:
+            # crop
+            i0 = (d - 1) // 2 + 1 if m % 2 == 0 else d // 2
+            return ifftshift(fftshift(src)[i0:i0 + n])
+        elif d < 0:
+            # pad
+            nleft = -d // 2 if m % 2 == 0 else (-d - 1) // 2 + 1
+            return ifftshift(np.pad(fftshift(src), (nleft, -d - nleft), constant_values=-1))
+        else:
+            return src
+
+    @staticmethod
+    def _gather(idx_map):
+        # dest and source indices of G vectors present on both grids
+        dest_idx = np.flatnonzero(idx_map >= 0)
+        return dest_idx, idx_map[dest_idx]
+
+    def resample_g(self, fg, real=False):
+        """Crop or pad G space function fg, see ftgg."""
+        m, n = self.m, self.n
+        if real:
+            assert fg.shape == (m[0] // 2 + 1, m[1], m[2])
+            idxs, shape = self.idxs_real, (n[0] // 2 + 1, n[1], n[2])
+        else:
+            assert fg.shape == m
+            idxs, shape = self.idxs, n
+
+        fgnew = np.zeros(shape, dtype=fg.dtype)
+        fgnew[np.ix_(*(d for d, s in idxs))] = fg[np.ix_(*(s for d, s in idxs))]
+        return fgnew
+
+    def resample_r(self, fr, source, dest):
+        """Fourier interpolate R space function fr from source grid to dest grid, see ftrr."""
+        assert (source.n1, source.n2, source.n3) == self.m
+        assert (dest.n1, dest.n2, dest.n3) == self.n
+        real = np.isrealobj(fr)
+        fg = ftrg(fr, source, real=real)
+        return ftgr(self.resample_g(fg, real=real), dest, real=real)
+
+
+_resamplers = {}
+
+
+def get_resampler(source, dest):
+    """Get the cached FourierResampler between grids of the sizes of source and dest."""
+    key = (source.n1, source.n2, source.n3), (dest.n1, dest.n2, dest.n3)
+    if key not in _resamplers:
+        _resamplers[key] = FourierResampler(*key)
+    return _resamplers[key]
 
 
 def ftgg(fg, source, dest, real=False):
@@ -47,105 +419,31 @@ def ftgg(fg, source, dest, real=False):
         dest (FFTGrid): FFT grid on which output is defined.
         real (bool): if True, fg is only defind on iG1 >= 0 and thus has the shape of
              (source.n1 // 2 + 1, source.n2, source.n3), and the returned array will be
-             of shape (dest.n1 // 2 + 1, source.n2, source.n3)
+             of shape (dest.n1 // 2 + 1, dest.n2, dest.n3)
 
     Returns:
         Cropped or padded G space function defined on dest grid.
     """
-    if real:
-        assert fg.shape == (source.n1h, source.n2, source.n3)
-    else:
-        assert fg.shape == (source.n1, source.n2, source.n3)
-
-    m = np.array([source.n1, source.n2, source.n3], dtype=int)
-    n = np.array([dest.n1, dest.n2, dest.n3], dtype=int)
-    d = m - n
-
-    if all(d == 0):
-        return
-
-    elif all(d > 0):
-        # crop fg
-        idxs = np.zeros(3, dtype=int)
-        for i in range(3):
-            if m[i] % 2 == 0:
-                # needed ?
-                idxs[i] = (d[i] - 1) // 2 + 1
-            else:
-                idxs[i] = d[i] // 2
-        if real:
-            fgnew = ifftshift(
-                fftshift(fg, axes=(1, 2))[
-                    0:n[0] // 2 + 1,
-                    idxs[1]:idxs[1] + n[1],
-                    idxs[2]:idxs[2] + n[2],
-                ], axes=(1, 2)
-            )
-        else:
-            fgnew = ifftshift(
-                fftshift(fg)[
-                    idxs[0]:idxs[0] + n[0],
-                    idxs[1]:idxs[1] + n[1],
-                    idxs[2]:idxs[2] + n[2],
-                ]
-            )
-
-    elif all(d < 0):
-        # pad fg
-        nleft = np.zeros(3, dtype=int)
-        for i in range(3):
-            if m[i] % 2 == 0:
-                nleft[i] = -d[i] // 2
-            else:
-                nleft[i] = (-d[i] - 1) // 2 + 1
-        if real:
-            fgnew = ifftshift(
-                np.pad(
-                    fftshift(fg, axes=(1, 2)),
-                    (
-                        (0, m[0] // 2 - n[0] // 2),
-                        (nleft[1], -d[1] - nleft[1]),
-                        (nleft[2], -d[2] - nleft[2])
-                    ),
-                    mode="constant"
-                ), axes=(1, 2)
-            )
-        else:
-            fgnew = ifftshift(
-                np.pad(
-                    fftshift(fg),
-                    (
-                        (nleft[0], -d[0] - nleft[0]),
-                        (nleft[1], -d[1] - nleft[1]),
-                        (nleft[2], -d[2] - nleft[2])
-                    ),
-                    mode="constant"
-                )
-            )
-    else:
-        raise ValueError("Unable to connect grid ({}, {}, {}) with grid ({}, {}, {})".format(
-            m[0], m[1], m[2], n[0], n[1], n[2]
-        ))
-
-    if real:
-        assert fgnew.shape == (dest.n1h, dest.n2, dest.n3)
-    else:
-        assert fgnew.shape == (dest.n1, dest.n2, dest.n3)
-    return fgnew
+    return get_resampler(source, dest).resample_g(fg, real=real)
 
 
-def ftrg(fr, grid):
+def ftrg(fr, grid, real=False):
     """Fourier transform function fr from R space to G space.
 
     Args:
         fr (np.ndarray): R space function. shape == (grid.n1, grid.n2, grid.n3).
         grid (FFTGrid): FFT grid on which fr is defined.
+        real (bool): if True, fr is real and only iG1 >= 0 is computed, the returned
+            array has the shape of (grid.n1 // 2 + 1, grid.n2, grid.n3).
 
     Returns:
         G space function.
     """
     assert fr.shape == (grid.n1, grid.n2, grid.n3)
-    return (1. / grid.N) * fftn(fr)
+    if real:
+        return (1. / grid.N) * grid.engine.rfftn(fr, axes=(1, 2, 0))
+    else:
+        return (1. / grid.N) * grid.engine.fftn(fr)
 
 
 def ftgr(fg, grid, real=False):
@@ -162,28 +460,27 @@ def ftgr(fg, grid, real=False):
     """
     if real:
         assert fg.shape == (grid.n1h, grid.n2, grid.n3)
-        fgzyx = fg.T
-        return grid.N * irfftn(fgzyx, s=(grid.n1, grid.n2, grid.n3)).T
+        return grid.N * grid.engine.irfftn(fg, s=(grid.n2, grid.n3, grid.n1), axes=(1, 2, 0))
     else:
         assert fg.shape == (grid.n1, grid.n2, grid.n3)
-        return grid.N * ifftn(fg)
+        return grid.N * grid.engine.ifftn(fg)
 
 
 def ftrr(fr, source, dest):
     """Fourier interpolate fr from source grid to dest grid.
 
+    Real functions are transformed with real FFTs on the half-spectrum.
+
     Args:
         fr (np.ndarray): R space function. shape == (source.n1, source.n2, source.n3)
         source (FFTGrid): FFT grid on which fr is defined.
         dest (FFTGrid): FFT grid on which output is defined.
 
     Returns:
-        Interpolated R space function defined on dest grid.
+        Interpolated R space function defined on dest grid; real if fr is real.
     """
     assert fr.shape == (source.n1, source.n2, source.n3)
-    fg = ftrg(fr, grid=source)
-    fgnew = ftgg(fg, source, dest)
-    return ftgr(fgnew, dest)
+    return get_resampler(source, dest).resample_r(fr, source, dest)
 
 
 def embedd_g(fg_arr, gvecs, grid, fill=None):
@@ -211,14 +508,17 @@ def embedd_g(fg_arr, gvecs, grid, fill=None):
     elif fill == "yz":
         fg = np.zeros((grid.n1h, grid.n2, grid.n3), dtype=np.complex_)
         fg[gvecs[:, 0], gvecs[:, 1], gvecs[:, 2]] = fg_arr
-        for ig2, ig3 in grid.yzlowerplane:
-            fg[0, ig2, ig3] = fg[0, -ig2, -ig3].conjugate()
+        # mirrors of lower points are upper points, so all can be filled at once
+        lower, mirror = grid.yzlowerplane
+        plane = fg[0].reshape(-1)
+        plane.put(lower, plane.take(mirror).conjugate())
 
     elif fill == "xyz":
         fg = np.zeros((grid.n1, grid.n2, grid.n3), dtype=np.complex_)
         fg[gvecs[:, 0], gvecs[:, 1], gvecs[:, 2]] = fg_arr
-        for ig1, ig2, ig3 in grid.xyzlowerspace:
-            fg[ig1, ig2, ig3] = fg[-ig1, -ig2, -ig3].conjugate()
+        lower, mirror = grid.xyzlowerspace
+        flat = fg.reshape(-1)
+        flat.put(lower, flat.take(mirror).conjugate())
 
     else:
         raise ValueError("fill = {}".format(fill))
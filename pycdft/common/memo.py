@@ -0,0 +1,101 @@
+""" On-disk cache of DFT evaluations of CDFT iterations. """
+
+import os
+import hashlib
+import numpy as np
+from pycdft.common.fileio import atomic_write
+
+
+class EvaluationCache(object):
+    """ Cache of DFT results for constraint potentials V on a given structure.
+
+    Entries are keyed by a hash of the structure, of the constraint definitions and of the
+    settings that change weights (promolecule densities, precision, compact_tol; see key)
+    and by the vector V of all constraints; a V within V_tol (max norm) of a stored
+    one is a hit. Each entry is a .npz file holding V, the tolerance of the inner SCF,
+    the DFT energies Ed and Ec, the electron numbers N of all constraints and the charge
+    density, in one directory per structure key. Entries written by earlier runs, e.g.
+    jobs being restarted, are found again. Entries do not record DFT settings
+    (functional, cutoff, ...), so a directory must only be shared by runs with the same
+    settings.
+
+    Attributes:
+        path (str): directory holding the cache entries.
+        V_tol (float): tolerance for V to match a stored entry.
+    """
+
+    def __init__(self, path: str, V_tol: float = 1.0E-6):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.V_tol = V_tol
+        self.entries = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(sample):
+        """ Compute the key of the structure, the constraints and the weight settings of sample. """
+        h = hashlib.sha1()
+        h.update("{} {} {} {} {} {}".format(
+            sample.vspin, sample.n1, sample.n2, sample.n3, sample.promolecule, sample.precision
+        ).encode())
+        h.update(np.ascontiguousarray(sample.R, dtype=np.float64).tobytes())
+        coords = np.array([atom.abs_coord for atom in sample.atoms], dtype=np.float64)
+        h.update(np.round(coords, 8).tobytes())
+        h.update(" ".join(atom.symbol for atom in sample.atoms).encode())
+        index = {id(atom): i for i, atom in enumerate(sample.atoms)}
+        for c in sample.constraints:
+            h.update("{} {} {} {}".format(c.type, c.eps, c.compact, c.compact_tol).encode())
+            for fragment, coeff in c.w_terms():
+                h.update("{} {}".format(coeff, [index[id(atom)] for atom in fragment.atoms]).encode())
+        return h.hexdigest()
+
+    def lookup(self, key: str, V, scf_tol: float = None):
+        """ Find an entry for V computed with an inner SCF tolerance at least as tight as scf_tol.
+
+        scf_tol = None stands for the settings of the DFT driver and only matches entries
+        computed with these settings.
+
+        Returns:
+            dict with keys V, scf_tol, Ed, Ec, N and rho_r, or None.
+        """
+        V = np.asarray(V, dtype=np.float64)
+        for entry in self._index(key):
+            if entry["V"].shape != V.shape or np.max(np.abs(entry["V"] - V)) > self.V_tol:
+                continue
+            if scf_tol is None:
+                match = entry["scf_tol"] is None
+            else:
+                match = entry["scf_tol"] is not None and entry["scf_tol"] <= scf_tol
+            if match:
+                with np.load(entry["file"]) as data:
+                    return dict(entry, rho_r=data["rho_r"])
+        return None
+
+    def store(self, key: str, V, scf_tol: float, Ed: float, Ec: float, N, rho_r: np.ndarray):
+        """ Add an entry, written atomically (see atomic_write). """
+        V = np.array(V, dtype=np.float64)
+        N = np.array(N, dtype=np.float64)
+        fname = os.path.join(
+            self.path, key, hashlib.sha1(V.tobytes() + repr(scf_tol).encode()).hexdigest() + ".npz"
+        )
+        with atomic_write(fname) as f:
+            np.savez(f, V=V, scf_tol=np.nan if scf_tol is None else scf_tol,
+                     Ed=Ed, Ec=Ec, N=N, rho_r=rho_r)
+        self._index(key).append(dict(V=V, scf_tol=scf_tol, Ed=Ed, Ec=Ec, N=N, file=fname))
+
+    def _index(self, key):
+        """ Entries of a structure without charge densities, read from disk on first use. """
+        if key not in self.entries:
+            self.entries[key] = []
+            dirname = os.path.join(self.path, key)
+            if os.path.isdir(dirname):
+                for fname in sorted(os.listdir(dirname)):
+                    if not fname.endswith(".npz"):
+                        continue
+                    fname = os.path.join(dirname, fname)
+                    with np.load(fname) as data:
+                        scf_tol = float(data["scf_tol"])
+                        self.entries[key].append(dict(
+                            V=data["V"], scf_tol=None if np.isnan(scf_tol) else scf_tol,
+                            Ed=float(data["Ed"]), Ec=float(data["Ec"]), N=data["N"], file=fname,
+                        ))
+        return self.entries[key]
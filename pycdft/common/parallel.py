@@ -0,0 +1,220 @@
+""" Parallel evaluation of per-atom quantities. """
+
+import gc
+import io
+import os
+import pickle
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from pycdft.common.ft import fft_workers_limit
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+_worker_token = None
+_worker_state = None
+_worker_blocks = {}
+
+
+class AtomExecutor(object):
+    """ Map a function over chunks of atoms with a pool of threads or processes.
+
+    func(state, sl) is called for slices sl of atom indices and the results are returned
+    in the order of the slices, so any reduction over them is deterministic and does not
+    depend on the number of workers.
+
+    The pool is created on first use and kept until close, so that an executor kept by
+    the caller (e.g. CDFTSolver) serves all geometry steps. Within workers, FFTs and BLAS
+    (if threadpoolctl is installed) use at most inner_threads threads each, so that
+    workers do not oversubscribe the cores.
+
+    Threads suit NumPy/FFT-heavy functions, which release the GIL. With processes, state
+    is pickled in every call; NumPy arrays larger than min_bytes (charge densities,
+    weights, atomic densities) are placed in shared memory instead of being copied, and
+    func must be a module-level function. Read-only arrays (e.g. Sample.rhoatom_g) are
+    copied to shared memory once and reused by later calls.
+
+    Attributes:
+        workers (int): number of workers; 1 evaluates serially in the calling thread.
+        kind (str): "thread" or "process".
+        chunks_per_worker (int): number of slices per worker, for load balancing.
+        min_bytes (int): arrays at least this large are shared with processes.
+        inner_threads (int): threads per FFT or BLAS call within workers; default = number
+                             of cores divided by workers, at least 1.
+    """
+
+    def __init__(self, workers: int = 1, kind: str = "thread", chunks_per_worker: int = 4,
+                 min_bytes: int = 2 ** 20, inner_threads: int = None):
+        if kind not in ("thread", "process"):
+            raise ValueError("Unknown executor {}".format(kind))
+        self.workers = workers
+        self.kind = kind
+        self.chunks_per_worker = chunks_per_worker
+        self.min_bytes = min_bytes
+        if inner_threads is None:
+            inner_threads = max(1, (os.cpu_count() or 1) // workers)
+        self.inner_threads = inner_threads
+        self.pool = None
+        self.static = {}
+        self.tokens = itertools.count()
+
+    def chunks(self, n: int):
+        nchunks = max(1, min(n, self.workers * self.chunks_per_worker))
+        bounds = np.linspace(0, n, nchunks + 1).astype(int)
+        return [slice(bounds[i], bounds[i + 1]) for i in range(nchunks)]
+
+    def map(self, func, state, n: int):
+        """ Evaluate func(state, sl) for slices sl covering range(n), returns list of results. """
+        chunks = self.chunks(n)
+        if self.workers == 1 or len(chunks) == 1:
+            return [func(state, sl) for sl in chunks]
+
+        if self.kind == "thread":
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            with limit_threads(self.inner_threads):
+                return list(self.pool.map(lambda sl: func(state, sl), chunks))
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        f = io.BytesIO()
+        pickler = _SharedPickler(f, self.min_bytes, self.static)
+        try:
+            pickler.dump(state)
+            payload = f.getvalue()
+            token = next(self.tokens)
+            n = len(chunks)
+            return list(self.pool.map(
+                _run, [token] * n, [payload] * n, [func] * n, chunks, [self.inner_threads] * n
+            ))
+        finally:
+            for shm in pickler.blocks:
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        """ Shut down the pool and release shared memory of read-only arrays. """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        for obj, shm, pid in self.static.values():
+            shm.close()
+            shm.unlink()
+        self.static = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # pools and shared memory are not copied
+        state = self.__dict__.copy()
+        state.update(pool=None, static={}, tokens=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tokens = itertools.count()
+
+
+@contextmanager
+def limit_threads(n):
+    """ Limit FFT and (with threadpoolctl) BLAS threads of the process to n. """
+    with fft_workers_limit(n):
+        if threadpool_limits is None:
+            yield
+        else:
+            with threadpool_limits(limits=n):
+                yield
+
+
+class _SharedPickler(pickle.Pickler):
+    """ Pickler placing large arrays in shared memory blocks owned by the parent.
+
+    Blocks of writeable arrays and views are collected in blocks and freed after the
+    call; blocks of read-only arrays owning their data are kept in static
+    (id -> (array, block, pid)) for later calls.
+    """
+
+    def __init__(self, file, min_bytes, static):
+        super(_SharedPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.min_bytes = min_bytes
+        self.static = static
+        self.blocks = []
+        self.pids = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.nbytes < self.min_bytes:
+            return None
+        # views (e.g. weights broadcast over spins) may change through their base
+        if obj.base is None and not obj.flags.writeable:
+            if id(obj) not in self.static:
+                shm, pid = self.share(obj)
+                # the array is kept alive so that its id is not reused
+                self.static[id(obj)] = (obj, shm, pid)
+            return self.static[id(obj)][2]
+        if id(obj) not in self.pids:
+            shm, self.pids[id(obj)] = self.share(obj)
+            self.blocks.append(shm)
+        return self.pids[id(obj)]
+
+    @staticmethod
+    def share(obj):
+        shm = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+        return shm, (shm.name, obj.shape, obj.dtype.str)
+
+
+class _SharedUnpickler(pickle.Unpickler):
+    def __init__(self, file):
+        super(_SharedUnpickler, self).__init__(file)
+        self.names = set()
+
+    def persistent_load(self, pid):
+        name, shape, dtype = pid
+        if name not in _worker_blocks:
+            _worker_blocks[name] = _attach(name)
+        self.names.add(name)
+        return np.ndarray(shape, dtype=dtype, buffer=_worker_blocks[name].buf)
+
+
+def _attach(name):
+    # the parent owns (and unlinks) the block, so it must not be tracked by the worker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _load_state(token, payload):
+    """ Unpickle the state of call token once per worker, detaching blocks of earlier calls. """
+    global _worker_token, _worker_state
+    if token == _worker_token:
+        return
+    # Sample and its atoms reference each other, so the old state is only freed by gc
+    _worker_state = None
+    gc.collect()
+    unpickler = _SharedUnpickler(io.BytesIO(payload))
+    state = unpickler.load()
+    for name in list(_worker_blocks):
+        if name not in unpickler.names:
+            _worker_blocks.pop(name).close()
+    _worker_token, _worker_state = token, state
+
+
+def _run(token, payload, func, sl, inner_threads):
+    _load_state(token, payload)
+    with limit_threads(inner_threads):
+        return func(_worker_state, sl)
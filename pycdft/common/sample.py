@@ -1,13 +1,19 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from random import randint
 from subprocess import Popen
-import warnings
 import numpy as np
-from numpy.fft import fftfreq
 from ase import Atoms
 from ase.io.cube import read_cube_data
-from pycdft.common.ft import fftn, ifftn
-from pycdft.atomic import rho_path, rd_grid, drd
+from scipy.interpolate import CubicSpline
+from pycdft.common.ft import ReciprocalGrid, ftrg, ftgr
+from pycdft.atomic import rd_grid
 from pycdft.atomic.pp import SG15PP
+from pycdft.atomic.bundle import load_rho_rd
+from pycdft.atomic.cache import RhoatomCache
+from pycdft.atomic.radial import RadialTransform
 from pycdft.common.atom import Atom
 from pycdft.common.units import angstrom_to_bohr, bohr_to_angstrom
 
@@ -28,12 +34,46 @@ class Sample(object):
         G (np.ndarray, shape = [3, 3]): the reciprocal space lattice vectors of the system.
         omega (float): cell volume.
         atoms (list of Atoms): list of atoms.
+        frozen (np.ndarray of bool, shape = [natoms]): mask of frozen atoms; constraint
+                                                       forces are neither computed nor
+                                                       applied for frozen atoms, and the
+                                                       DFT driver keeps them fixed during
+                                                       geometry optimization.
         fragments (list of Fragments): list of fragments defined on the sample.
         rhopro_tot_r (np.ndarray, shape = [n1, n2, n3]): total promolecule density.
         vspin (int): number of spin channels (1 or 2) for constraint potential. Note that
                      as long as only charge constraints are present, vspin = 1 even if the
                      system may be spin-polarized.
         n1, n2, n3 (int): FFT grid for charge density, weight function and constraint potential.
+        ggrid (ReciprocalGrid): G vectors of the FFT grid.
+        cache (RhoatomCache): on-disk cache of atomic densities rhoatom_g, enabled by the
+                              cache_dir argument or the PYCDFT_CACHE_DIR environment variable.
+        promolecule (str): how promolecule densities are computed. "fft": sum of atomic
+                           densities in G space followed by FFT. "realspace": atomic densities
+                           are summed on R space grid points within the cutoff of each atom;
+                           cost scales with number of atoms instead of grid size, which is
+                           favorable for large cells with a lot of vacuum. Constraint forces
+                           use gradients of atomic densities computed the same way, so in
+                           both modes they are the derivative of the constrained energy.
+        rhopro_coords (np.ndarray, shape = [natoms, 3]): coordinates of atoms at which their
+                                                      contributions to promolecule densities
+                                                      were computed.
+        weights (WeightStack): dense weights of all constraints, stored in one block.
+        disp_tol (float): atoms displaced by less than disp_tol from rhopro_coords are
+                          considered fixed when updating promolecule densities.
+        precision (str): "double" or "single", precision of charge density, promolecule
+                         densities, weights and constraint potentials stored on the grid.
+                         Reductions (electron numbers and forces) are always accumulated in
+                         double precision. With single precision the relative error of
+                         stored quantities is below 2^-24 ~ 6e-8; the error of N is below
+                         1e-7 times the number of electrons, far below N_tol, and the error
+                         of Fc is below 1e-5 times the largest constraint force.
+                         G space intermediates are kept in double precision, as rounding
+                         errors there spread over the whole cell and would spoil weights
+                         in low density regions.
+        rdtype (np.dtype): dtype of R space quantities corresponding to precision.
+        grad_cache (GradientCache): memo of compute_rhoatom_grad_r, active within
+                                    force_context.
         Ed (float): :math:`E_d`, DFT energy.
         Ec (float): :math:`E_c`, Constraint energy.
         W (float): free energy. :math:`W = E_d + E_c - \sum_k V_k N_k`
@@ -43,7 +83,8 @@ class Sample(object):
     """
 
     def __init__(self, ase_cell: Atoms, vspin: int, n1: int, n2: int, n3: int,
-                 atomic_density_files: dict = None):
+                 atomic_density_files: dict = None, cache_dir: str = None,
+                 promolecule: str = "fft", precision: str = "double"):
 
         # define cell
         self.R = ase_cell.get_cell() * angstrom_to_bohr
@@ -52,6 +93,7 @@ class Sample(object):
         self.omega = np.linalg.det(self.R)
         self.atoms = list(Atom(sample=self, ase_atom=atom) for atom in ase_cell)
         self.natoms = len(self.atoms)
+        self.frozen = np.zeros(self.natoms, dtype=bool)
         self.species = sorted(set([atom.symbol for atom in self.atoms]))
         self.nspecies = len(self.species)
 
@@ -76,33 +118,62 @@ class Sample(object):
         # define charge density and promolecule charge densities
         self.rho_r = None
         self.rhopro_tot_r = None
+        self.rhopro_coords = None
+        self.rhopro_fragments = None
+        self.disp_tol = 1.0E-6
         self.rhoatom_g = {}
         self.rhoatom_rd = {}
+        self.rhoatom_spline = {}
+        self.grad_cache = None
+        self.weights = None
+
+        if promolecule not in ("fft", "realspace"):
+            raise ValueError("Unknown promolecule mode {}".format(promolecule))
+        if promolecule == "realspace" and atomic_density_files is not None:
+            raise ValueError("realspace promolecule requires spherically averaged atomic densities")
+        self.promolecule = promolecule
+
+        if precision not in ("double", "single"):
+            raise ValueError("Unknown precision {}".format(precision))
+        self.precision = precision
+        self.rdtype = np.dtype(np.float64 if precision == "double" else np.float32)
+
+        # G vectors on the [n1, n2, n3] grid, kept as separable 1D components;
+        # G components and |G|^2 on the full grid are generated on demand.
+        # All densities are real, so only the half-spectrum iG1 >= 0 is used in G space
+        self.ggrid = ReciprocalGrid(self.G, n1, n2, n3, real=True)
+
+        # compute atomic density for all species; rhoatom_g is reused from the on-disk
+        # cache (if any) when the same species, cell, grid and density file were seen before
+        if cache_dir is None:
+            cache_dir = os.environ.get("PYCDFT_CACHE_DIR")
+        self.cache = RhoatomCache(cache_dir) if cache_dir else None
 
-        # compute the norm of all G vectors on the [n1, n2, n3] grid
-        G1, G2, G3 = self.G
-        # all Gx,Gy,Gz values
-        G1s = np.outer(G1, fftfreq(n1, d=1. / n1))
-        G2s = np.outer(G2, fftfreq(n2, d=1. / n2))
-        G3s = np.outer(G3, fftfreq(n3, d=1. / n3))
-
-        # make grid from G1s, G2s,G3s using Python built-in broadcasting
-        self.Gx_g = (G1s[0, :, np.newaxis, np.newaxis]
-                     + G2s[0, np.newaxis, :, np.newaxis]
-                     + G3s[0, np.newaxis, np.newaxis, :])
-        self.Gy_g = (G1s[1, :, np.newaxis, np.newaxis]
-                     + G2s[1, np.newaxis, :, np.newaxis]
-                     + G3s[1, np.newaxis, np.newaxis, :])
-        self.Gz_g = (G1s[2, :, np.newaxis, np.newaxis]
-                     + G2s[2, np.newaxis, :, np.newaxis]
-                     + G3s[2, np.newaxis, np.newaxis, :])
-
-        self.G2_g = self.Gx_g ** 2 + self.Gy_g ** 2 + self.Gz_g ** 2
-
-        # compute atomic density for all species
         if atomic_density_files is not None:
-            # read atomic density from file
+            sources = {}
+            for s in self.species:
+                with open(atomic_density_files[s], "rb") as f:
+                    sources[s] = f.read()
+        else:
+            # pre-computed spherically-averaged atomic density located in atomic/rho,
+            # normalized to the number of valence electrons
             for s in self.species:
+                self.rhoatom_rd[s] = load_rho_rd(s)
+            sources = {s: self.rhoatom_rd[s].tobytes() for s in self.species}
+
+        keys = {}
+        for s in self.species:
+            if self.cache is not None:
+                keys[s] = self.cache.key(s, self.R, (n1, n2, n3), sources[s])
+                rho_g = self.cache.load(keys[s])
+                if rho_g is not None:
+                    self.rhoatom_g[s] = rho_g
+
+        missing = [s for s in self.species if s not in self.rhoatom_g]
+
+        if atomic_density_files is not None:
+            # read atomic density from file
+            for s in missing:
                 rho_r, ase_cell = read_cube_data(atomic_density_files[s])
                 omega = ase_cell.get_volume() * angstrom_to_bohr**3
                 assert rho_r.shape == (n1, n2, n3) 
@@ -112,12 +183,8 @@ class Sample(object):
                 rho_r1 = np.roll(rho_r, n1 // 2, axis=0)
                 rho_r2 = np.roll(rho_r1, n2 // 2, axis=1)
                 rho_r3 = np.roll(rho_r2, n3 // 2, axis=2)
-                # self.rhoatom_g[s] = omega / self.n * fftn(rho_r3)
-                self.rhoatom_g[s] = omega / self.n * fftn(rho_r3)
-        else:
-            # calculate atomic density from pre-computed spherically-averaged atomic density
-            # located in atomic/rho
-
+                self.rhoatom_g[s] = omega * ftrg(rho_r3, self.ggrid, real=True)
+        elif missing:
             # define mapping from all G vectors to G vectors with unique norm
             #  i.e., repeated |G| are excluded
 
@@ -125,62 +192,216 @@ class Sample(object):
             # tocheck: is 0.02 integration step sufficient
             
             # rd_grid size set to [251,]; 5 Ang cutoff with 0.02 Ang step
-            # Gmapping, rho_g: n1 x n2 x n3 
-            # sinrG: rd_grid x unique |G| 
-            G2_d = np.sort(np.array(list(set(self.G2_g.flatten()))))
-            self.Gmapping = np.searchsorted(G2_d, self.G2_g)
-            self.G_d = np.sqrt(G2_d)
-            self.sinrG = np.sin(np.outer(rd_grid, self.G_d))
+            # Gmapping, rho_g: n1h x n2 x n3
+            # rho(|G|) is tabulated on a fine 1D |G| grid and interpolated onto G_d
+            Gmapping, G_d = self.ggrid.shells()
+            transform = RadialTransform(Gmax=G_d[-1])
 
             # rho(G) = 4 pi int( rho(r) r sinGr / G )
-            # rho(G=0) = 4 pi int( rho(r) r^2 ) = nel / omega
+            for s in missing:
+                self.rhoatom_g[s] = transform(self.rhoatom_rd[s], G_d)[Gmapping]
 
-            for s in self.species:
-                rho_rd = np.loadtxt(
-                    "{}/{}.spavr".format(rho_path, s), dtype=float)[:, 1]
-                rho_rd[rho_rd < 0] = 0
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    rho_d = 4 * np.pi * drd * np.einsum("r,rg->g", rho_rd * rd_grid, self.sinrG / self.G_d)
-                rho_g = rho_d[self.Gmapping]
-                rho_g[0, 0, 0] = 4 * np.pi * drd * np.sum(rho_rd * rd_grid ** 2)
-                fac = SG15PP[s]["nel"] / rho_g[0, 0, 0]
-                rho_rd *= fac
-                rho_g *= fac  # normalize charge density
-                self.rhoatom_g[s] = rho_g
-                self.rhoatom_rd[s] = rho_rd
+        if self.cache is not None:
+            for s in missing:
+                self.cache.save(keys[s], self.rhoatom_g[s])
 
-    def update_weights(self):
-        """ Update weights with new structure. """
-        n = self.n1 * self.n2 * self.n3
-        omega = self.omega
+        # atomic densities are fixed; read-only arrays are shared once with worker processes
+        for rho_g in self.rhoatom_g.values():
+            rho_g.flags.writeable = False
 
-        # Update promolecule densities
-        self.rhopro_tot_r = np.zeros([self.n1, self.n2, self.n3], dtype=np.complex_)
-        for f in self.fragments:
-            f.rhopro_r = np.zeros([self.n1, self.n2, self.n3], dtype=np.complex_)
+    @property
+    def mobile(self):
+        """ Indices of atoms that are not frozen. """
+        return np.flatnonzero(~self.frozen)
 
-        for atom in self.atoms:
-            rhog = self.compute_rhoatom_g(atom)
-            self.rhopro_tot_r += rhog
-            for f in self.fragments:
-                if atom in f.atoms:
-                    f.rhopro_r += rhog
+    def freeze(self, atoms: list, frozen: bool = True):
+        """ Freeze (or unfreeze) atoms. """
+        ids = set(id(atom) for atom in atoms)
+        for i, atom in enumerate(self.atoms):
+            if id(atom) in ids:
+                self.frozen[i] = frozen
 
-        # self.rhopro_tot_r = (n / omega) * ifftn(self.rhopro_tot_r).real  # FT G -> R
-        self.rhopro_tot_r = (n / omega) * ifftn(self.rhopro_tot_r).real  # FT G -> R
-        for f in self.fragments:
-            # f.rhopro_r = (n / omega) * ifftn(f.rhopro_r).real
-            f.rhopro_r = (n / omega) * ifftn(f.rhopro_r).real
+    def update_weights(self):
+        """ Update weights with new structure.
+
+        If only some atoms moved since the last update, the old contributions of these
+        atoms to promolecule densities are subtracted and the new ones added. Promolecule
+        densities are rebuilt from scratch on first call, when fragments changed or when
+        more than half of the atoms moved.
+        """
+        coords = np.array([atom.abs_coord for atom in self.atoms])
+        fragments = [(f, list(f.atoms)) for f in self.fragments]
+
+        if self.rhopro_coords is None or fragments != self.rhopro_fragments:
+            moved = None
+        else:
+            disp = np.linalg.norm(coords - self.rhopro_coords, axis=1)
+            moved = list(np.flatnonzero(disp > self.disp_tol))
+            # updating an atom costs twice as much as adding it
+            if 2 * len(moved) > self.natoms:
+                moved = None
+
+        if moved is None or moved:
+            if self.promolecule == "realspace":
+                self.update_rhopro_r(moved)
+            else:
+                self.update_rhopro_g(moved)
+
+        if moved is None:
+            self.rhopro_coords = coords
+            self.rhopro_fragments = fragments
+        else:
+            self.rhopro_coords[moved] = coords[moved]
 
         # Update weights
-        for c in self.constraints:
-            c.update_structure()
+        if self.constraints:
+            self.constraints[0].update_structure_all(self.constraints)
 
-    def compute_eigr(self, atom: Atom, axis=None):
-        r""" Compute :math:`e^{-i\bf{G} \cdot \bf{R}}` array where R is coordinate of atom."""
+    def update_rhopro_g(self, moved: list = None):
+        """ Update promolecule densities by summing atomic densities in G space.
+
+        Args:
+            moved (list of int): if given, only the contributions of these atoms are
+                                 updated, from rhopro_coords to their current coordinates.
+        """
+        omega = self.omega
+        iatoms = range(self.natoms) if moved is None else moved
+
+        def structure_factor(iatoms):
+            r = np.array([self.atoms[i].abs_coord for i in iatoms])
+            coeffs = np.ones(len(iatoms))
+            if moved is not None:
+                r = np.concatenate([r, self.rhopro_coords[iatoms]])
+                coeffs = np.concatenate([coeffs, -coeffs])
+            return self.compute_structure_factor(r, coeffs)
+
+        # Update promolecule densities; for every species, the contribution to a density
+        # is rho_s(G) times the structure factor of the atoms of that species
+        rhopro_tot_g = np.zeros(self.ggrid.shape, dtype=np.complex_)
+        rhopro_g = [np.zeros(self.ggrid.shape, dtype=np.complex_) for f in self.fragments]
+        updated = [moved is None for f in self.fragments]
+
+        for s in self.species:
+            iatoms_s = [i for i in iatoms if self.atoms[i].symbol == s]
+            if not iatoms_s:
+                continue
+            rhopro_tot_g += self.rhoatom_g[s] * structure_factor(iatoms_s)
+            for ifrag, f in enumerate(self.fragments):
+                iatoms_f = [i for i in iatoms_s if self.atoms[i] in f.atoms]
+                if iatoms_f:
+                    rhopro_g[ifrag] += self.rhoatom_g[s] * structure_factor(iatoms_f)
+                    updated[ifrag] = True
+
+        rhopro_tot_r = ftgr(rhopro_tot_g, self.ggrid, real=True) / omega  # FT G -> R
+        if moved is None:
+            self.rhopro_tot_r = rhopro_tot_r.astype(self.rdtype)
+        else:
+            self.rhopro_tot_r += rhopro_tot_r
+        for f, rhog_f, updated_f in zip(self.fragments, rhopro_g, updated):
+            if not updated_f:
+                continue
+            rhopro_r = ftgr(rhog_f, self.ggrid, real=True) / omega
+            if moved is None:
+                f.rhopro_r = rhopro_r.astype(self.rdtype)
+            else:
+                f.rhopro_r += rhopro_r
+
+    def update_rhopro_r(self, moved: list = None):
+        """ Update promolecule densities by summing atomic densities in R space.
+
+        Args:
+            moved (list of int): if given, only the contributions of these atoms are
+                                 updated, from rhopro_coords to their current coordinates.
+        """
         n1, n2, n3 = self.n1, self.n2, self.n3
+        if moved is None:
+            self.rhopro_tot_r = np.zeros([n1, n2, n3], dtype=self.rdtype)
+            for f in self.fragments:
+                f.rhopro_r = np.zeros([n1, n2, n3], dtype=self.rdtype)
+
+        for i in range(self.natoms) if moved is None else moved:
+            atom = self.atoms[i]
+            terms = [(atom.abs_coord, 1)]
+            if moved is not None:
+                terms.append((self.rhopro_coords[i], -1))
+            for abs_coord, sign in terms:
+                idx, rho = self.compute_rhoatom_r_box(atom.symbol, abs_coord)
+                rho *= sign
+                self.rhopro_tot_r[idx] += rho
+                for f in self.fragments:
+                    if atom in f.atoms:
+                        f.rhopro_r[idx] += rho
+
+    def compute_rhoatom_r_box(self, symbol: str, abs_coord: np.ndarray, grad: bool = False):
+        r""" Compute charge density of an atom on R space grid points within the cutoff.
+
+        Grid point (i, j, k) is located at :math:`i/n_1 \bf{R}_1 + j/n_2 \bf{R}_2 + k/n_3 \bf{R}_3`.
+        Points closer than the cutoff rd_grid[-1] to the atom lie in a box of the grid whose
+        extent along each axis is set by the spacing of lattice planes. Indices of the box
+        are wrapped into the cell; if the box is larger than the cell along some axis,
+        contributions of periodic images falling on the same grid point are summed.
+
+        Args:
+            symbol (str): chemical symbol of the atom.
+            abs_coord (np.ndarray, shape = [3]): coordinate of the atom in bohr.
+            grad (bool): if True, the nuclear gradient of the charge density is returned
+                         instead, from the derivative of the same spline.
+
+        Returns:
+            idx (tuple): open mesh of grid indices of the box, to index R space arrays.
+            rho (np.ndarray): charge density on the box, or its nuclear gradient with
+                              shape = [3, b1, b2, b3].
+        """
+        rcut = rd_grid[-1]
+        if symbol not in self.rhoatom_spline:
+            self.rhoatom_spline[symbol] = CubicSpline(rd_grid, self.rhoatom_rd[symbol])
+
+        ns = (self.n1, self.n2, self.n3)
+        cry_coord = self.G @ abs_coord / (2 * np.pi)
+        # 2 pi / |G_i| is the distance between lattice planes normal to G_i
+        extent = rcut * np.linalg.norm(self.G, axis=1) / (2 * np.pi)
+
+        ijk = []
+        for i in range(3):
+            lo = int(np.ceil((cry_coord[i] - extent[i]) * ns[i]))
+            hi = int(np.floor((cry_coord[i] + extent[i]) * ns[i]))
+            ijk.append(np.arange(lo, hi + 1))
+        # displacement from the atom to grid points of the box, shape = [b1, b2, b3, 3]
+        d = [np.outer(ijk[i] / ns[i] - cry_coord[i], self.R[i]) for i in range(3)]
+        disp = d[0][:, None, None, :] + d[1][None, :, None, :] + d[2][None, None, :, :]
+        dr = np.linalg.norm(disp, axis=-1)
+        inside = dr <= rcut
+
+        if grad:
+            # d rho(|r - R|) / dR = - rho'(|r - R|) (r - R) / |r - R|
+            rho = np.zeros((3,) + dr.shape)
+            inside &= dr > 0
+            drho = self.rhoatom_spline[symbol](dr[inside], 1)
+            rho[:, inside] = -(drho / dr[inside]) * disp[inside].T
+        else:
+            rho = np.zeros(dr.shape)
+            rho[inside] = self.rhoatom_spline[symbol](dr[inside])
+
+        idx = []
+        lead = rho.ndim - 3
+        for i in range(3):
+            wrapped = ijk[i] % ns[i]
+            if len(ijk[i]) > ns[i]:
+                # several images along this axis, fold them onto the cell
+                axis = lead + i
+                wrapped, inverse = np.unique(wrapped, return_inverse=True)
+                folded = np.zeros(rho.shape[:axis] + (len(wrapped),) + rho.shape[axis + 1:])
+                np.add.at(folded, (slice(None),) * axis + (inverse,), rho)
+                rho = folded
+            idx.append(wrapped)
+
+        return np.ix_(*idx), rho
+
+    def compute_eigr(self, atom: Atom, axis=None):
+        r""" Compute :math:`e^{-i\bf{G} \cdot \bf{R}}` array where R is coordinate of atom.
 
+        The array is defined on the half-spectrum G space grid (iG1 >= 0).
+        """
         if axis is None:
             r = atom.abs_coord
         else:
@@ -191,9 +412,7 @@ class Sample(object):
         igr2 = -1j * self.G[1] @ r
         igr3 = -1j * self.G[2] @ r
 
-        hs = fftfreq(n1, d=1 / n1)
-        ks = fftfreq(n2, d=1 / n2)
-        ls = fftfreq(n3, d=1 / n3)
+        hs, ks, ls = self.ggrid.freqs
 
         eigr1 = np.exp(igr1 * hs)
         eigr2 = np.exp(igr2 * ks)
@@ -202,30 +421,196 @@ class Sample(object):
 
         return eigr
 
+    def compute_structure_factor(self, r: np.ndarray, coeffs=None, chunk_bytes=2 ** 26):
+        r""" Compute :math:`S(G) = \sum_I c_I e^{-i\bf{G} \cdot \bf{R}_I}` for atoms at coordinates r.
+
+        :math:`e^{-i\bf{G} \cdot \bf{R}_I}` factorizes into three 1D phase factors, so S(G)
+        is accumulated by one matrix product per chunk of atoms instead of one full grid
+        per atom. The array is defined on the half-spectrum G space grid (iG1 >= 0).
+
+        Args:
+            r (np.ndarray, shape = [natoms, 3]): absolute coordinates.
+            coeffs (np.ndarray, shape = [natoms]): weights c_I, default to 1.
+            chunk_bytes (int): approximate memory used for intermediates.
+        """
+        r = np.asarray(r, dtype=np.float64).reshape(-1, 3)
+        if coeffs is None:
+            coeffs = np.ones(len(r))
+        m1, n2, n3 = self.ggrid.shape
+        sfac = np.zeros([m1, n2, n3], dtype=np.complex_)
+        if len(r) == 0:
+            return sfac
+
+        hs, ks, ls = self.ggrid.freqs
+        eigr1 = np.exp(-1j * np.outer(r @ self.G[0], hs)) * np.asarray(coeffs)[:, np.newaxis]
+        eigr2 = np.exp(-1j * np.outer(r @ self.G[1], ks))
+        eigr3 = np.exp(-1j * np.outer(r @ self.G[2], ls))
+
+        chunk = max(1, chunk_bytes // (16 * m1 * n2))
+        sfac2d = sfac.reshape(m1 * n2, n3)
+        for i in range(0, len(r), chunk):
+            sl = slice(i, i + chunk)
+            eigr12 = np.einsum("Ih,Ik->hkI", eigr1[sl], eigr2[sl]).reshape(m1 * n2, -1)
+            sfac2d += eigr12 @ eigr3[sl]
+
+        return sfac
+
     def compute_rhoatom_g(self, atom: Atom):
-        """ Compute charge density for an atom with specific coordinate in cell. """
+        """ Compute charge density for an atom with specific coordinate in cell.
+
+        Only the half-spectrum (iG1 >= 0) is returned, see ftgr for the inverse transform.
+        """
         rhog0 = self.rhoatom_g[atom.symbol]
         eigr = self.compute_eigr(atom)
  
         return rhog0 * eigr
 
-    def compute_rhoatom_grad_r(self, atom: Atom):
-        """ Compute nuclear gradient for atom. """
-        rhog = self.rhoatom_g[atom.symbol] # eigr in update_weights
+    @contextmanager
+    def force_context(self, max_bytes=2 ** 30):
+        """ Memoize nuclear gradients of atomic densities within a force evaluation.
+
+        Within the context, compute_rhoatom_grad_r results are kept in an LRU cache of at
+        most max_bytes, so that several constraints share the gradient of each atom.
+        Entries are keyed by species and coordinates, so the cache is never stale.
+        """
+        outer = self.grad_cache
+        if outer is None:
+            self.grad_cache = GradientCache(max_bytes)
+        try:
+            yield self.grad_cache
+        finally:
+            self.grad_cache = outer
 
+    def compute_rhoatom_grad_r(self, atom: Atom):
+        """ Compute nuclear gradient for atom.
+
+        Within force_context the result is memoized and must not be modified.
+        """
+        if self.grad_cache is not None:
+            key = (atom.symbol, atom.abs_coord.tobytes())
+            rho_grad_r = self.grad_cache.get(key)
+            if rho_grad_r is None:
+                rho_grad_r = self._compute_rhoatom_grad_r(atom)
+                rho_grad_r.flags.writeable = False
+                self.grad_cache.put(key, rho_grad_r)
+            return rho_grad_r
+        return self._compute_rhoatom_grad_r(atom)
+
+    def _compute_rhoatom_grad_r(self, atom: Atom):
         n1, n2, n3 = self.n1, self.n2, self.n3
-        rho_grad_r = np.zeros([3, n1, n2, n3])
-        n = self.n
+        rho_grad_r = np.zeros([3, n1, n2, n3], dtype=self.rdtype)
+
+        if self.promolecule == "realspace":
+            idx, grad = self.compute_rhoatom_r_box(atom.symbol, atom.abs_coord, grad=True)
+            rho_grad_r[(slice(None),) + idx] = grad
+            return rho_grad_r
+
+        rhog = self.rhoatom_g[atom.symbol] * self.compute_eigr(atom)
         omega = self.omega
 
         for i in range(3):
-            eigr = self.compute_eigr(atom, axis=i)
-            g = [self.Gx_g, self.Gy_g, self.Gz_g][i]
-            # rho_grad_r[i] = (n / omega) * ifftn(-1j * g * eigr * rhog).real
-            rho_grad_r[i] = (n / omega) * ifftn(-1j * g * eigr * rhog).real
+            g = self.ggrid.component(i)
+            rho_grad_r[i] = ftgr(-1j * g * rhog, self.ggrid, real=True) / omega
 
         return rho_grad_r
 
+    def integrate_rhoatom_grad(self, field_g: np.ndarray, atoms: list, chunk_bytes=2 ** 26):
+        r""" Compute :math:`\int f({\bf r}) \nabla_{{\bf R}_I} \rho_I({\bf r}) d{\bf r}` for a list of atoms.
+
+        The integral equals :math:`\sum_G -i{\bf G} \rho_I(G) e^{-i{\bf G} \cdot {\bf R}_I} f^*(G)`.
+        For real f the sum over all G is real and is obtained from the half-spectrum
+        (iG1 >= 0) by counting planes 0 < iG1 < n1 / 2 twice. The phase factor is a product
+        of three 1D phase factors, so the sum is evaluated by matrix products over chunks of
+        atoms; no R space gradient grids are built.
+
+        Several functions f can be integrated at once, sharing the phase factors.
+
+        Args:
+            field_g (np.ndarray, shape = ggrid.shape or [nf, *ggrid.shape]):
+                f(G) = ftrg(f, ggrid, real=True), for one or nf functions.
+            atoms (list of Atom): atoms.
+            chunk_bytes (int): approximate memory used for intermediates.
+
+        Returns:
+            np.ndarray, shape = [len(atoms), 3] or [nf, len(atoms), 3].
+        """
+        m1, n2, n3 = self.ggrid.shape
+        single = field_g.ndim == 3
+        if single:
+            field_g = field_g[np.newaxis]
+        nf = len(field_g)
+        out = np.zeros([nf, len(atoms), 3])
+
+        wgt = np.full(m1, 2.0)
+        wgt[0] = 1.0
+        if self.n1 % 2 == 0:
+            wgt[-1] = 1.0
+        fc = wgt[:, np.newaxis, np.newaxis] * np.conj(field_g)
+
+        hs, ks, ls = self.ggrid.freqs
+        G1s, G2s, G3s = self.ggrid.Gs
+        chunk = max(1, chunk_bytes // (64 * nf * m1 * n2))
+
+        for s in self.species:
+            iatoms = [i for i, atom in enumerate(atoms) if atom.symbol == s]
+            if not iatoms:
+                continue
+            P = (self.rhoatom_g[s] * fc).reshape(nf * m1 * n2, n3)
+            r = np.array([atoms[i].abs_coord for i in iatoms])
+
+            for i0 in range(0, len(iatoms), chunk):
+                rc = r[i0:i0 + chunk]
+                nat = len(rc)
+                eigr1 = np.exp(-1j * np.outer(hs, rc @ self.G[0]))
+                eigr2 = np.exp(-1j * np.outer(ks, rc @ self.G[1]))
+                eigr3 = np.exp(-1j * np.outer(ls, rc @ self.G[2]))
+
+                # sum over iG3 of P e^{-iG3.R} and of P G3_a e^{-iG3.R}
+                eigr3g = np.concatenate(
+                    [eigr3[:, None, :], G3s.T[:, :, None] * eigr3[:, None, :]], axis=1
+                )
+                R3 = (P @ eigr3g.reshape(n3, 4 * nat)).reshape(nf, m1, n2, 4, nat)
+
+                # sum over iG2; S[..., 0, :] has no G factor, S[..., 1:, :] has G2_a + G3_a
+                eigr2g = G2s.T[:, :, None] * eigr2[:, None, :]
+                S = np.einsum("fhkbI,kI->fhbI", R3, eigr2)
+                S[:, :, 1:] += np.einsum("fhkI,kaI->fhaI", R3[:, :, :, 0], eigr2g)
+
+                # sum over iG1
+                T = G1s.T[:, :, None] * S[:, :, 0:1] + S[:, :, 1:]
+                out[:, iatoms[i0:i0 + chunk]] = (-1j * np.einsum("fhaI,hI->fIa", T, eigr1)).real
+
+        return out[0] if single else out
+
+    def integrate_rhoatom_grad_r(self, field_r: np.ndarray, atoms: list):
+        r""" Compute :math:`\int f({\bf r}) \nabla_{{\bf R}_I} \rho_I({\bf r}) d{\bf r}` on R space boxes.
+
+        Used with promolecule = "realspace": gradients of atomic densities are evaluated
+        on the box of grid points within the cutoff of each atom from the same splines as
+        the promolecule densities (see compute_rhoatom_r_box), so the integrals are exact
+        derivatives of integrals of weights built by update_rhopro_r.
+
+        Args:
+            field_r (np.ndarray, shape = [n1, n2, n3] or [nf, n1, n2, n3]): one or nf
+                functions f on the R space grid.
+            atoms (list of Atom): atoms.
+
+        Returns:
+            np.ndarray, shape = [len(atoms), 3] or [nf, len(atoms), 3].
+        """
+        single = field_r.ndim == 3
+        if single:
+            field_r = field_r[np.newaxis]
+        out = np.zeros([len(field_r), len(atoms), 3])
+        for iatom, atom in enumerate(atoms):
+            idx, grad = self.compute_rhoatom_r_box(atom.symbol, atom.abs_coord, grad=True)
+            out[:, iatom] = np.einsum(
+                "fijk,aijk->fa", field_r[(slice(None),) + idx], grad, dtype=np.float64
+            )
+        out *= self.omega / self.n
+
+        return out[0] if single else out
+
     @property
     def ase_cell(self):
         """ Get an ASE Atoms object of current cell."""
@@ -289,3 +674,46 @@ class Sample(object):
 
     def __str__(self):
         return self.__repr__()
+
+
+class GradientCache(object):
+    """ LRU cache of nuclear gradients of atomic densities, bounded in bytes.
+
+    Attributes:
+        max_bytes (int): maximum total size of cached arrays.
+        nbytes (int): current total size of cached arrays.
+
+    The cache may be shared by threads evaluating forces of different atoms.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value: np.ndarray):
+        if value.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            while self.nbytes + value.nbytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+            self.entries[key] = value
+            self.nbytes += value.nbytes
+
+    def __getstate__(self):
+        # worker processes start from an empty cache
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
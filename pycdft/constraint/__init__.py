@@ -1,3 +1,4 @@
 from .base import Constraint
+from .weight import CompactWeight, WeightStack
 from .charge import ChargeConstraint
 from .charge_transfer import ChargeTransferConstraint
@@ -1,6 +1,9 @@
 from abc import ABCMeta, abstractmethod
 import numpy as np
 from pycdft.common.sample import Sample
+from pycdft.common.ft import ftrg
+from pycdft.common.parallel import AtomExecutor
+from pycdft.constraint.weight import CompactWeight, WeightStack
 
 
 class Constraint(object):
@@ -15,16 +18,24 @@ class Constraint(object):
         V (float): Lagrangian multiplier associate with the constraint.
         V_init (float): Initial guess or bracket for V, used for certain optimization algorithms.
         V_brak (2-tuple of float): Search bracket for V, used for certain optimization algorithms.
-        Vc (np.ndarray, shape = [vspin, n1, n2, n3]): constraint potential.
-        w (np.ndarray, shape = [vspin, n1, n2, n3]): weight function.
+        Vc (np.ndarray, shape = [vspin, n1, n2, n3]): constraint potential, set by update_Vc.
+        w (np.ndarray, shape = [vspin, n1, n2, n3]): weight function. Dense weights are
+                                                    read-only views broadcasting w_r over spins.
+        w_r (np.ndarray, shape = [n1, n2, n3]): dense weight, the same for all spins; a slot
+                                               of Sample.weights after update_structure_all.
         N_tol (float): convergence threshold for N - N0 (= dW/dV).
+        compact (bool): if True, w and Vc are stored as CompactWeight.
+        compact_tol (float): tolerance for treating w as exactly 0, 1 or -1 in CompactWeight;
+                             the error introduced in N is at most compact_tol times the
+                             number of electrons.
     """
 
     __metaclass__ = ABCMeta
     type = None
 
     @abstractmethod
-    def __init__(self, sample: Sample, N0, V_init=None, V_brak=None, N_tol=None):
+    def __init__(self, sample: Sample, N0, V_init=None, V_brak=None, N_tol=None,
+                 compact=False, compact_tol=1.0E-10):
         """
         Args:
             V_init (float): initial guess for V.
@@ -34,9 +45,12 @@ class Constraint(object):
         self.V_init = V_init
         self.V_brak = V_brak
         self.N_tol = N_tol
+        self.compact = compact
+        self.compact_tol = compact_tol
 
         self.V = None
         self.w = None
+        self.w_r = None
         self.N = None
         self.Vc = None
         self.Fc = None
@@ -59,36 +73,274 @@ class Constraint(object):
         self.update_w()
         self.update_N()
 
+    @staticmethod
+    def update_structure_all(constraints):
+        """ Update several constraints on the same sample with new structure.
+
+        Dense weights of all constraints are built in one WeightStack (Sample.weights)
+        sharing 1 / rho_pro_tot; compact weights are updated one by one.
+        """
+        if not constraints:
+            return
+        sample = constraints[0].sample
+        dense = [c for c in constraints if not c.compact]
+        if dense and (sample.weights is None or sample.weights.constraints != dense):
+            sample.weights = WeightStack(dense)
+        for c in constraints:
+            print("Updating constraint with new structure...")
+            if c.compact:
+                c.update_w()
+        if dense:
+            sample.weights.update()
+        Constraint.update_N_all(constraints)
+
     @abstractmethod
     def update_w(self):
         """ Update the weight with new structure. """
         pass
 
+    @abstractmethod
+    def w_terms(self):
+        """ Fragments (and coefficients 1 or -1) whose promolecule densities sum to the weight numerator. """
+        pass
+
+    def set_w(self, w):
+        """ Set the weight from its values on the [n1, n2, n3] grid, same for all spins. """
+        vspin = self.sample.vspin
+        if self.compact:
+            self.w = CompactWeight(w, vspin, tol=self.compact_tol)
+            return
+        if self.w_r is not None and self.w_r.shape == w.shape:
+            # in place, w_r may be a slot of Sample.weights
+            self.w_r[...] = w
+        else:
+            self.w_r = w
+        self.w = np.broadcast_to(self.w_r, (vspin, *w.shape))
+
     def update_N(self):
-        """ Update the electron number or electron number difference. """
+        """ Update the electron number or electron number difference.
+
+        w is the same for all spins, so the charge density is summed over spins first.
+        """
         omega = self.sample.omega
         n = self.sample.n1 * self.sample.n2 * self.sample.n3
         rho_r = self.sample.rho_r
-        self.N = (omega / n) * np.sum(self.w * rho_r)
+        if self.compact:
+            self.N = (omega / n) * self.w.dot(rho_r)
+        else:
+            rho_tot_r = np.sum(rho_r, axis=0, dtype=np.float64)
+            self.N = (omega / n) * np.dot(self.w_r.reshape(-1), rho_tot_r.reshape(-1))
+
+    @staticmethod
+    def update_N_all(constraints):
+        """ Update electron numbers of several constraints, with one contraction for Sample.weights. """
+        if not constraints:
+            return
+        sample = constraints[0].sample
+        stacked = sample.weights.constraints if sample.weights is not None else []
+        if any(c in stacked for c in constraints):
+            for c, N in zip(stacked, sample.weights.compute_N(sample.rho_r)):
+                c.N = N
+        for c in constraints:
+            if c not in stacked:
+                c.update_N()
+
+    @staticmethod
+    def compute_Vc_tot(constraints):
+        """ Compute the total constraint potential of several constraints.
+
+        Constraints with weights in Sample.weights are summed in one contraction with
+        their V, without building Vc of each constraint.
+        """
+        sample = constraints[0].sample
+        stacked = sample.weights.constraints if sample.weights is not None else []
+        if stacked and all(c in constraints for c in stacked):
+            Vc_tot = sample.weights.compute_Vc([c.V for c in stacked])
+        else:
+            stacked, Vc_tot = [], 0
+        for c in constraints:
+            if c not in stacked:
+                c.update_Vc()
+                Vc_tot = c.Vc + Vc_tot
+        return Vc_tot
 
     def update_Vc(self):
         """ Update constraint potential. """
-        self.Vc = self.V * self.w
+        if self.compact:
+            self.Vc = self.V * self.w
+        else:
+            self.Vc = np.broadcast_to(
+                np.multiply(self.w_r, self.V, dtype=self.w_r.dtype), self.w.shape
+            )
+
+    def update_Fc(self, method="gspace"):
+        r""" Update constraint force.
+
+        :math:`F_I = -V \int n({\bf r}) \nabla_{{\bf R}_I} w({\bf r}) d{\bf r}
+        = -V \int (\delta_I A({\bf r}) - B({\bf r})) \nabla_{{\bf R}_I} \rho_I({\bf r}) d{\bf r}`,
+        where :math:`A = n / \rho_{pro}`, :math:`B = w A` and :math:`\delta_I` is given by delta.
+
+        Args:
+            method (str): "gspace": A and B are Fourier transformed once and contracted with
+                          the G space gradient of atomic densities of all atoms (default).
+                          "rspace": the gradient of the atomic density of every atom is built
+                          on the R space grid; slow, kept for verification.
+        """
+        Constraint.update_Fc_all([self], method=method)
+
+    @staticmethod
+    def update_Fc_all(constraints, method="gspace", workers=1, executor="thread", pool=None):
+        """ Update constraint forces of several constraints on the same sample in one pass.
+
+        With method "gspace", A and B of all constraints are contracted together so that
+        phase factors of every atom are computed once. With method "rspace", the loop over
+        atoms is outermost and the gradient of each atom is shared by all constraints
+        through Sample.force_context.
+
+        With Sample.promolecule = "realspace", gradients of atomic densities are evaluated
+        on the R space box of each atom like the promolecule densities, and "gspace"
+        contracts A and B with them on the boxes instead of in G space.
+
+        Forces on frozen atoms (Sample.frozen) are not computed and set to zero.
+        Mobile atoms are split into contiguous chunks evaluated by an AtomExecutor; forces are
+        assembled in atom order, so results do not depend on the number of workers.
+
+        Args:
+            constraints (list of Constraint): constraints.
+            method (str): see update_Fc.
+            workers (int): number of workers.
+            executor (str): "thread" or "process", see AtomExecutor.
+            pool (AtomExecutor): executor kept by the caller across calls; if given,
+                                 workers and executor are ignored.
+        """
+        if not constraints:
+            return
+        sample = constraints[0].sample
+        atoms = sample.atoms
+        mobile = sample.mobile
+        if len(mobile) == 0:
+            for c in constraints:
+                c.Fc = np.zeros([sample.natoms, 3])
+            return
+        if pool is None:
+            with AtomExecutor(workers, executor) as pool:
+                Constraint.update_Fc_all(constraints, method=method, pool=pool)
+            return
+
+        if method == "gspace":
+            if sample.promolecule == "realspace":
+                func, transform = _integrate_rhoatom_grad_r, np.asarray
+            else:
+                func = _integrate_rhoatom_grad
+                transform = lambda f: ftrg(f, sample.ggrid, real=True)
+            # A only depends on eps, so it is shared by constraints with the same eps
+            fields, iA, iB = [], {}, []
+            for c in constraints:
+                A, B = c.compute_force_fields()
+                if c.eps not in iA:
+                    iA[c.eps] = len(fields)
+                    fields.append(transform(A))
+                iB.append(len(fields))
+                fields.append(transform(B))
+            D = np.concatenate(
+                pool.map(func, (sample, np.array(fields), mobile), len(mobile)), axis=1
+            )
+            for c, i in zip(constraints, iB):
+                delta = np.array([c.delta(atoms[iatom]) for iatom in mobile])
+                c.Fc = np.zeros([sample.natoms, 3])
+                c.Fc[mobile] = - c.V * (delta[:, np.newaxis] * D[iA[c.eps]] - D[i])
+
+        elif method == "rspace":
+            fields = [c.compute_force_fields() if c.compact else None for c in constraints]
+            with sample.force_context():
+                Fc = np.concatenate(
+                    pool.map(_compute_Fc_rspace, (constraints, fields, mobile), len(mobile)),
+                    axis=1
+                )
+            for c, Fc_c in zip(constraints, Fc):
+                c.Fc = np.zeros([sample.natoms, 3])
+                c.Fc[mobile] = Fc_c
+
+        else:
+            raise ValueError("Unknown method {}".format(method))
 
-    def update_Fc(self):
-        """ Update constraint force. """
+    def compute_Fc_rspace(self, atom, fields=None):
+        """ Compute the constraint force on atom from R space gradients.
+
+        Args:
+            atom (Atom): atom.
+            fields (2-tuple of np.ndarray): A and B from compute_force_fields, required for
+                                            compact weights.
+        """
         omega = self.sample.omega
         n = self.sample.n
-        self.Fc = np.zeros([self.sample.natoms, 3])
-
-        for iatom, atom in enumerate(self.sample.atoms):
-            # s is spin index, a is coordinate (i.e., x,y,z) index
-            # i,j,k is dimensions of FFT grid = n1, n2, n3
-            w_grad = self.compute_w_grad_r(atom)
-            self.Fc[iatom] = - self.V * (omega / n) * np.einsum(
-                "sijk,asijk->a", self.sample.rho_r, w_grad
+        if self.compact:
+            A, B = fields
+            rho_grad_r = self.sample.compute_rhoatom_grad_r(atom)
+            return - self.V * (omega / n) * np.einsum(
+                "aijk,ijk->a", rho_grad_r, self.delta(atom) * A - B, dtype=np.float64
             )
 
+        # a is coordinate (i.e., x,y,z) index
+        # i,j,k is dimensions of FFT grid = n1, n2, n3
+        # w is the same for all spins, so the charge density is summed over spins first
+        w_grad = self.compute_w_grad_r(atom)
+        rho_tot_r = np.sum(self.sample.rho_r, axis=0, dtype=np.float64)
+        return - self.V * (omega / n) * np.einsum(
+            "ijk,aijk->a", rho_tot_r, w_grad, dtype=np.float64
+        )
+
+    def compute_force_fields(self):
+        """ Compute A = rho / rhopro_tot and B = w A on the R space grid.
+
+        w is the same for all spins, so the charge density is summed over spins.
+        """
+        rhopro_tot_r = self.sample.rhopro_tot_r
+        with np.errstate(divide="ignore", invalid="ignore"):
+            A = np.sum(self.sample.rho_r, axis=0, dtype=np.float64) / rhopro_tot_r
+        A[rhopro_tot_r < self.eps] = 0.0
+        B = self.w.multiply(A) if self.compact else self.w_r * A
+        return A, B
+
     @abstractmethod
-    def compute_w_grad_r(self, atom):
+    def delta(self, atom):
+        """ Derivative of the weight numerator with respect to the density of atom (0, 1 or -1). """
         pass
+
+    def compute_w_grad_r(self, atom):
+        """ Nuclear gradient of the weight for atom, shape = [3, n1, n2, n3], the same for all spins. """
+        w_r = self.w.spatial() if self.compact else self.w_r
+        rhopro_tot_r = self.sample.rhopro_tot_r
+        rho_grad_r = self.sample.compute_rhoatom_grad_r(atom)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            w_grad = np.einsum(
+                "ijk,aijk,ijk->aijk", self.delta(atom) - w_r, rho_grad_r, 1 / rhopro_tot_r
+            )
+        w_grad[:, rhopro_tot_r < self.eps] = 0.0
+        return w_grad
+
+    def debug_w_grad_r(self, atom):
+        """ Nuclear gradients of the weight and of the atomic density of atom, for plotting. """
+        return self.compute_w_grad_r(atom), self.sample.compute_rhoatom_grad_r(atom)
+
+
+def _integrate_rhoatom_grad(state, sl):
+    sample, fields_g, mobile = state
+    return sample.integrate_rhoatom_grad(fields_g, [sample.atoms[i] for i in mobile[sl]])
+
+
+def _integrate_rhoatom_grad_r(state, sl):
+    sample, fields_r, mobile = state
+    return sample.integrate_rhoatom_grad_r(fields_r, [sample.atoms[i] for i in mobile[sl]])
+
+
+def _compute_Fc_rspace(state, sl):
+    constraints, fields, mobile = state
+    sample = constraints[0].sample
+    Fc = np.zeros([len(constraints), sl.stop - sl.start, 3])
+    with sample.force_context():
+        for iatom, i in enumerate(mobile[sl]):
+            atom = sample.atoms[i]
+            for ic, (c, fields_c) in enumerate(zip(constraints, fields)):
+                Fc[ic, iatom] = c.compute_Fc_rspace(atom, fields_c)
+    return Fc
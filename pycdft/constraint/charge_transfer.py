@@ -1,7 +1,7 @@
-import numpy as np
 from pycdft.common.sample import Sample
 from pycdft.common.fragment import Fragment
 from pycdft.constraint.base import Constraint
+from pycdft.constraint.weight import inverse_rhopro
 
 
 class ChargeTransferConstraint(Constraint):
@@ -18,9 +18,10 @@ class ChargeTransferConstraint(Constraint):
     type = "charge transfer"
 
     def __init__(self, sample: Sample, donor: Fragment, acceptor: Fragment, N0: float,
-                 V_init=0, V_brak=(-1, 1), N_tol=1.0E-3, eps=1e-6):
+                 V_init=0, V_brak=(-1, 1), N_tol=1.0E-3, eps=1e-6, compact=False):
         super(ChargeTransferConstraint, self).__init__(
-            sample, N0, V_init=V_init, V_brak=V_brak, N_tol=N_tol
+            sample, N0, V_init=V_init, V_brak=V_brak, N_tol=N_tol,
+            compact=compact,
         )
         self.eps = eps
         self.donor = donor
@@ -29,48 +30,18 @@ class ChargeTransferConstraint(Constraint):
 
     def update_w(self):
         #w = (self.acceptor.rhopro_r - self.donor.rhopro_r) / self.sample.rhopro_tot_r
-        w = (self.donor.rhopro_r - self.acceptor.rhopro_r) / self.sample.rhopro_tot_r
-        w[self.sample.rhopro_tot_r < self.eps] = 0.0
-        if self.sample.vspin == 1:
-            self.w = w[None, ...]
-        else:
-            self.w = np.append(w, w, axis=0).reshape(2, *w.shape)
-
-    def compute_w_grad_r(self, atom):
-        if atom in self.donor.atoms:
-            delta = 1
-        elif atom in self.acceptor.atoms:
-            delta = -1
-        else:
-            delta = 0
-
-        rho_grad_r = self.sample.compute_rhoatom_grad_r(atom)
-        w_grad = np.einsum(
-            "sijk,aijk,ijk->asijk", delta - self.w, rho_grad_r, 1 / self.sample.rhopro_tot_r
+        w = (self.donor.rhopro_r - self.acceptor.rhopro_r) * inverse_rhopro(
+            self.sample.rhopro_tot_r, self.eps
         )
-        for icart, ispin in np.ndindex(3, self.sample.vspin):
-            w_grad[icart, ispin][self.sample.rhopro_tot_r < self.eps] = 0.0
-        return w_grad
+        self.set_w(w)
+
+    def w_terms(self):
+        return [(self.donor, 1), (self.acceptor, -1)]
 
-    # added for debuggin forces
-    def debug_w_grad_r(self, atom):
+    def delta(self, atom):
         if atom in self.donor.atoms:
-            delta = 1
+            return 1
         elif atom in self.acceptor.atoms:
-            delta = -1
-            #delta = 0 # should reproduce charge constains in He_2^+
-                       # but instead half reproduces a-d and w_grad is no longer symmetric
+            return -1
         else:
-            delta = 0
-
-        rho_grad_r = self.sample.compute_rhoatom_grad_r(atom)
-        w_grad = np.einsum(
-            "sijk,aijk,ijk->asijk", delta - self.w, rho_grad_r, 1 / self.sample.rhopro_tot_r
-        )
-#        w_grad_part = np.einsum(
-#            "sijk,ijk-> sijk", delta - self.w, 1 / self.sample.rhopro_tot_r
-#        )
-
-        for icart, ispin in np.ndindex(3, self.sample.vspin):
-            w_grad[icart, ispin][self.sample.rhopro_tot_r < self.eps] = 0.0
-        return w_grad, rho_grad_r
+            return 0
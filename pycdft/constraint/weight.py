@@ -0,0 +1,172 @@
+import numpy as np
+
+
+def inverse_rhopro(rhopro_tot_r: np.ndarray, eps: float, dtype=None):
+    """ Compute 1 / rhopro_tot_r, set to 0 where rhopro_tot_r < eps. """
+    # rhopro_tot_r vanishes far from atoms for realspace promolecule densities
+    with np.errstate(divide="ignore"):
+        inv = np.divide(1, rhopro_tot_r, dtype=dtype)
+    inv[rhopro_tot_r < eps] = 0.0
+    return inv
+
+
+class CompactWeight(object):
+    """ Weight function stored compactly.
+
+    Hirshfeld weights are exactly 0 where the promolecule density vanishes and equal to
+    0, 1 or -1 up to round-off far from fragment boundaries. Only the flat indices of
+    points where w = 1 or w = -1 and the values of w at all remaining nonzero (active)
+    points are stored; w = 0 everywhere else. Weights of charge and charge transfer
+    constraints are the same for all spin channels, so one spatial grid is kept.
+
+    Multiplying by a scalar (e.g. V * w for the constraint potential) returns a
+    CompactWeight sharing the same arrays. Adding to an array returns a dense array.
+
+    Attributes:
+        shape (tuple): shape of the dense weight, [vspin, n1, n2, n3].
+        plus (np.ndarray): flat indices of points where w = 1.
+        minus (np.ndarray): flat indices of points where w = -1.
+        index (np.ndarray): flat indices of active points.
+        value (np.ndarray): w on active points.
+        scale (float): factor multiplying all values.
+    """
+
+    # numpy defers binary operators with ndarray to CompactWeight
+    __array_ufunc__ = None
+
+    def __init__(self, w: np.ndarray, vspin: int, tol: float = 0.0):
+        """
+        Args:
+            w (np.ndarray, shape = [n1, n2, n3]): dense weight.
+            vspin (int): number of spin channels.
+            tol (float): points with w within tol of 0, 1 or -1 are treated as constant.
+        """
+        self.shape = (vspin, *w.shape)
+        w = w.ravel()
+        self.plus = np.flatnonzero(np.abs(w - 1) <= tol)
+        self.minus = np.flatnonzero(np.abs(w + 1) <= tol)
+        self.index = np.flatnonzero(
+            (np.abs(w) > tol) & (np.abs(w - 1) > tol) & (np.abs(w + 1) > tol)
+        )
+        self.value = w[self.index]
+        self.scale = 1.0
+
+    @property
+    def nbytes(self):
+        return self.plus.nbytes + self.minus.nbytes + self.index.nbytes + self.value.nbytes
+
+    def spatial(self):
+        """ Get dense weight on the [n1, n2, n3] grid. """
+        out = np.zeros(self.shape[1:], dtype=self.value.dtype)
+        self._add_to(out.reshape(-1))
+        return out
+
+    def dense(self):
+        """ Get dense weight, shape = [vspin, n1, n2, n3]. """
+        return np.array(np.broadcast_to(self.spatial(), self.shape))
+
+    def dot(self, f: np.ndarray):
+        r""" Compute :math:`\sum_{s,{\bf r}} w_s({\bf r}) f_s({\bf r})` for f of shape [vspin, n1, n2, n3]. """
+        f = np.sum(f, axis=0, dtype=np.float64).reshape(-1)
+        return self.scale * (
+            np.sum(f[self.plus]) - np.sum(f[self.minus]) + self.value @ f[self.index]
+        )
+
+    def multiply(self, f: np.ndarray):
+        """ Compute w * f for f defined on the [n1, n2, n3] grid. """
+        f = f.reshape(-1)
+        out = np.zeros(f.shape, dtype=np.result_type(self.value, f))
+        out[self.plus] = f[self.plus]
+        out[self.minus] = -f[self.minus]
+        out[self.index] = self.value * f[self.index]
+        return (self.scale * out).reshape(self.shape[1:])
+
+    def _add_to(self, out: np.ndarray):
+        out[self.plus] += self.scale
+        out[self.minus] -= self.scale
+        out[self.index] += self.scale * self.value
+
+    def __mul__(self, other):
+        cw = object.__new__(CompactWeight)
+        cw.__dict__.update(self.__dict__)
+        cw.scale = self.scale * other
+        return cw
+
+    __rmul__ = __mul__
+
+    def __add__(self, other):
+        out = self.dense()
+        out += other
+        return out
+
+    __radd__ = __add__
+
+    def __array__(self, dtype=None, copy=None):
+        return self.dense() if dtype is None else self.dense().astype(dtype)
+
+
+class WeightStack(object):
+    """ Dense weights of several constraints stored as one block.
+
+    Hirshfeld weights of all constraints share the denominator rho_pro_tot, so
+    1 / rho_pro_tot is computed once and every weight is built in place in its slot
+    of the block. Weights are the same for all spins, so one grid is stored per
+    constraint; w_r of each constraint is its slot and w broadcasts it over spins.
+    Electron numbers
+    of all constraints are then computed in one contraction with the charge density,
+    and the total constraint potential in one contraction with the vector of V.
+
+    Attributes:
+        constraints (list of Constraint): constraints whose weights are stored.
+        w (np.ndarray, shape = [k, n1, n2, n3]): weights.
+    """
+
+    def __init__(self, constraints: list):
+        sample = constraints[0].sample
+        self.sample = sample
+        self.constraints = list(constraints)
+        self.w = np.empty(
+            [len(constraints), sample.n1, sample.n2, sample.n3], dtype=sample.rdtype
+        )
+
+    def update(self):
+        """ Update weights from promolecule densities. """
+        rhopro_tot_r = self.sample.rhopro_tot_r
+        inv = {}
+        for i, c in enumerate(self.constraints):
+            if c.eps not in inv:
+                inv[c.eps] = inverse_rhopro(rhopro_tot_r, c.eps, dtype=self.w.dtype)
+            w = self.w[i]
+            for j, (fragment, coeff) in enumerate(c.w_terms()):
+                if j == 0:
+                    np.multiply(fragment.rhopro_r, coeff, out=w, casting="same_kind")
+                elif coeff == 1:
+                    w += fragment.rhopro_r
+                else:
+                    w -= fragment.rhopro_r
+            w *= inv[c.eps]
+            c.w_r = w
+            c.w = np.broadcast_to(w, (self.sample.vspin, *w.shape))
+
+    def compute_N(self, rho_r: np.ndarray, chunk_bytes=2 ** 26):
+        r""" Compute :math:`\int w_k({\bf r}) \rho({\bf r}) d{\bf r}` for all constraints.
+
+        The charge density is summed over spins first. The contraction runs over chunks
+        of the grid so that single precision quantities are accumulated in double precision.
+        """
+        w = self.w.reshape(len(self.constraints), -1)
+        rho = rho_r.reshape(rho_r.shape[0], -1)
+        m = max(1, chunk_bytes // (8 * (len(self.constraints) + 1)))
+        N = np.zeros(len(self.constraints))
+        for i in range(0, w.shape[1], m):
+            N += np.tensordot(
+                w[:, i:i + m].astype(np.float64, copy=False),
+                np.sum(rho[:, i:i + m], axis=0, dtype=np.float64),
+                axes=1,
+            )
+        return (self.sample.omega / self.sample.n) * N
+
+    def compute_Vc(self, V):
+        """ Compute the total constraint potential sum_k V_k w_k, shape = [vspin, n1, n2, n3]. """
+        Vc = np.tensordot(np.asarray(V, dtype=self.w.dtype), self.w, axes=1)
+        return np.broadcast_to(Vc, (self.sample.vspin, *Vc.shape))
@@ -1,6 +1,6 @@
 import numpy as np
 from ase.io.cube import write_cube
-from pycdft.common.ft import fftn, ifftn
+from pycdft.common.ft import ftgr
 
 # Compatible for PyCDFT v0.1
 #   Helper functions for debugging the forces in PyCDFT
@@ -46,7 +46,7 @@ def get_hirsh(CDFTSolver,origin):
         atoms_write = CDFTSolver.sample.ase_cell # writing requires ASE Atom type
 
         # write to cube file for visualizing
-        weights_dat = parse(c.w[0],-1)
+        weights_dat = parse(np.asarray(c.w)[0],-1)
 
         filname="hirshr"+str(index)+".cube"
         fileobj=open(filname,"w")
@@ -71,7 +71,7 @@ def get_hirsh_ct(CDFTSolver,origin):
     for c in constraints:
         atoms = CDFTSolver.sample.ase_cell
         # write to cube file for visualizing
-        weights_dat = parse(c.w[0],-1)
+        weights_dat = parse(np.asarray(c.w)[0],-1)
 
         filname="hirshr"+str(index)+".cube"
         fileobj=open(filname,"w")
@@ -95,14 +95,12 @@ def get_rho_atom(CDFTSolver,origin):
     """
     atoms_iter = CDFTSolver.sample.atoms    # calculating requires pycdft-modified Atom type
     atoms_write = CDFTSolver.sample.ase_cell # writing requires ASE Atom type
-    n = CDFTSolver.sample.n
     omega = CDFTSolver.sample.omega
 
     index = 1
     for atom in atoms_iter:
         rhoatom_g = CDFTSolver.sample.compute_rhoatom_g(atom)
-        rhoatom_r = (n / omega) * ifftn(rhoatom_g).real # FT G -> R
-        #rhoatom_r = (n / omega) * ifftn(rhoatom_g).real # FT G -> R
+        rhoatom_r = ftgr(rhoatom_g, CDFTSolver.sample.ggrid, real=True) / omega # FT G -> R
 
         # write to cube file 
         rhoatom_r = parse(rhoatom_r,-1)
@@ -170,7 +168,7 @@ def get_grad(CDFTSolver,origin):
             # write to cube file for visualizing
             # separate file for each cartesian direction
             for icart in range(3):               
-                w_grad_tmp = parse(w_grad[icart][0],-1)
+                w_grad_tmp = parse(w_grad[icart],-1)
                 rho_grad_r_tmp = parse(rho_grad_r[icart],-1)
    
                 fil1="w_grad_atom"+str(ia)+"_c"+str(ic)+"_i"+str(icart)+".cube"
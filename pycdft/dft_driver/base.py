@@ -38,10 +38,14 @@ class DFTDriver(object):
         pass
 
     @abstractmethod
-    def run_scf(self):
+    def run_scf(self, scf_tol: float = None):
         """ Order the DFT code to perform SCF calculation under the constraint.
 
         Returns when SCF calculation is finished.
+
+        Args:
+            scf_tol (float): convergence threshold of this SCF calculation; None uses the
+                             settings of the driver.
         """
         pass
 
@@ -62,7 +66,11 @@ class DFTDriver(object):
 
     @abstractmethod
     def set_Fc(self):
-        """ Set the constraint force in the DFT code."""
+        """ Set the constraint force in the DFT code.
+
+        Atoms frozen in Sample.frozen get no constraint force and must be kept fixed by
+        the DFT code in the following run_opt.
+        """
         pass
 
     @abstractmethod
@@ -74,6 +82,16 @@ class DFTDriver(object):
     def get_wfc(self):
         """ Fetch the wavefunction from the DFT code."""
         pass
+
+    @abstractmethod
+    def save_state(self, fname):
+        """ Order the DFT code to save its structure and wavefunction to file fname."""
+        pass
+
+    @abstractmethod
+    def load_state(self, fname):
+        """ Order the DFT code to load structure and wavefunction saved by save_state."""
+        pass
   
     @abstractmethod
     def exit(self):
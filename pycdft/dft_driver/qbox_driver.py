@@ -93,7 +93,8 @@ class QboxDriver(DFTDriver):
         n1, n2, n3 = self.sample.n1, self.sample.n2, self.sample.n3
         assert isinstance(Vc, np.ndarray) and Vc.shape == (vspin, n1, n2, n3)
 
-        data = base64.encodebytes(Vc.T.tobytes()).strip()  # reverse order of x, y, z direction
+        # Qbox reads double precision data
+        data = base64.encodebytes(Vc.T.astype(np.float64).tobytes()).strip()  # reverse order of x, y, z direction
         R = self.sample.R
         f = self.f3d_template.format(
             R00=R[0, 0], R01=R[0, 1], R02=R[0, 2],
@@ -112,9 +113,17 @@ class QboxDriver(DFTDriver):
             self.output_path, self.istep, self.icscf
         ))
 
-    def run_scf(self):
-        """ Run SCF calculation in Qbox."""
-        self.run_cmd(self.scf_cmd)
+    def run_scf(self, scf_tol: float = None):
+        """ Run SCF calculation in Qbox.
+
+        scf_tol sets the Qbox variable scf_tol (energy change in Hartree) before running
+        scf_cmd, ending the SCF before the maximum number of iterations in scf_cmd once
+        converged. Qbox keeps the value for later calls.
+        """
+        if scf_tol is None:
+            self.run_cmd(self.scf_cmd)
+        else:
+            self.run_cmd("set scf_tol {:.2E}\n{}".format(scf_tol, self.scf_cmd))
         self.scf_xml = etree.parse(self.output_file).getroot()
         etotal = float(self.scf_xml.findall("iteration/etotal")[-1].text)
         eext = float(self.scf_xml.findall("iteration/eext")[-1].text)
@@ -140,7 +149,7 @@ class QboxDriver(DFTDriver):
         """
         vspin = self.sample.vspin
         n1, n2, n3 = self.sample.n1, self.sample.n2, self.sample.n3
-        self.sample.rho_r = np.zeros([vspin, n1, n2, n3])
+        self.sample.rho_r = np.zeros([vspin, n1, n2, n3], dtype=self.sample.rdtype)
 
         for ispin in range(vspin):
             # Qbox generates charge density
@@ -177,19 +186,27 @@ class QboxDriver(DFTDriver):
                     self.sample.Fd[index-1] = f
 
     def set_Fc(self):
-        """ Implement abstract set_force method for Qbox."""
+        """ Implement abstract set_force method for Qbox.
+
+        External forces of all atoms are redefined, so that atoms frozen since the last
+        call lose theirs. Frozen atoms get no external force and are fixed in place by a
+        Qbox position constraint, so run_opt does not move them.
+        """
         cmd = ""
-        for i in range(self.sample.natoms):
-            symbol = self.sample.atoms[i].symbol
-            cmd += "extforce delete f{}{}\n".format(symbol, i + 1)
+        for i, atom in enumerate(self.sample.atoms):
+            qb_sym = atom.symbol + str(i + 1)
+            cmd += "extforce delete f{}\n".format(qb_sym)
+            cmd += "constraint delete p{}\n".format(qb_sym)
 
         Fc = self.sample.Fc
-        for i in range(self.sample.natoms):
-            symbol = self.sample.atoms[i].symbol
-            qb_sym = symbol + str(i+1)
-            cmd += "extforce define f{} {} {:06f} {:06f} {:06f}\n".format(
-                qb_sym, qb_sym, Fc[i][0], Fc[i][1], Fc[i][2]
-            )
+        for i, atom in enumerate(self.sample.atoms):
+            qb_sym = atom.symbol + str(i + 1)
+            if self.sample.frozen[i]:
+                cmd += "constraint define position p{} {}\n".format(qb_sym, qb_sym)
+            else:
+                cmd += "extforce define f{} {} {:06f} {:06f} {:06f}\n".format(
+                    qb_sym, qb_sym, Fc[i][0], Fc[i][1], Fc[i][2]
+                )
         self.run_cmd(cmd)
 
     def get_structure(self):
@@ -309,6 +326,19 @@ class QboxDriver(DFTDriver):
         self.sample.wfc = self.parse_wfc_from_file(wfcfile)
         print("QboxDriver: loaded wfc from file for restart.")
 
+    def save_state(self, fname):
+        """ Save the Qbox sample (atoms and wavefunction) to an XML file."""
+        self.run_cmd("save {}".format(fname))
+
+    def load_state(self, fname):
+        """ Load a Qbox sample saved by save_state.
+
+        Qbox settings from init_cmd are kept; the constraint potential and constraint
+        forces are set again before the next SCF and relaxation step.
+        """
+        self.run_cmd("load {}".format(fname))
+        print("QboxDriver: loaded sample from {} for resume.".format(fname))
+
     def exit(self):
         """ Quit DFT driver """
         open(self.input_file, "w").write("quit" + "\n")
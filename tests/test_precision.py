@@ -0,0 +1,53 @@
+""" Single precision storage (Sample.precision) against the double precision path. """
+
+import numpy as np
+import pytest
+from ase import Atoms
+from pycdft import Sample, Fragment, ChargeConstraint, ChargeTransferConstraint
+from pycdft.constraint import Constraint
+
+
+def make_sample(precision, vspin, compact):
+    cell = Atoms("COH2", positions=[[4.0, 4.0, 3.4], [4.0, 4.0, 4.6], [4.0, 4.9, 2.8], [4.0, 3.1, 2.8]],
+                 cell=np.eye(3) * 8.0)
+    sample = Sample(ase_cell=cell, vspin=vspin, n1=32, n2=32, n3=32, precision=precision)
+    c1 = ChargeConstraint(sample, Fragment(sample, sample.atoms[1:2]), N0=6.0, compact=compact)
+    c2 = ChargeTransferConstraint(sample, donor=Fragment(sample, sample.atoms[0:1]),
+                                  acceptor=Fragment(sample, sample.atoms[2:4]), N0=1.0,
+                                  compact=compact)
+    c1.V, c2.V = 0.3, -0.2
+    return sample
+
+
+def synthetic_rho_r(sample):
+    """ Positive, smooth density close to the promolecule density, split unevenly over spins. """
+    sample.rho_r = np.zeros([sample.vspin, sample.n1, sample.n2, sample.n3])
+    sample.update_weights()
+    rhopro = np.asarray(sample.rhopro_tot_r, dtype=np.float64)
+    x = np.arange(sample.n1) / sample.n1
+    rho = rhopro * (1 + 0.2 * np.sin(2 * np.pi * x))[:, None, None]
+    if sample.vspin == 1:
+        return rho[None]
+    return np.array([0.6 * rho, 0.4 * rho])
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("vspin", [1, 2])
+def test_single_precision_N_and_Fc(vspin, compact):
+    results = {}
+    for precision in ["double", "single"]:
+        sample = make_sample(precision, vspin, compact)
+        rho_r = synthetic_rho_r(make_sample("double", vspin, compact))
+        sample.rho_r = rho_r.astype(sample.rdtype)
+        sample.update_weights()
+        assert sample.rho_r.dtype == sample.rdtype
+        assert sample.rhopro_tot_r.dtype == sample.rdtype
+        Constraint.update_Fc_all(sample.constraints)
+        nel = sample.omega / sample.n * np.sum(rho_r)
+        results[precision] = (np.array([c.N for c in sample.constraints]),
+                              np.array([c.Fc for c in sample.constraints]), nel)
+
+    N_d, Fc_d, nel = results["double"]
+    N_s, Fc_s, _ = results["single"]
+    assert np.max(np.abs(N_s - N_d)) < 1.0E-7 * nel
+    assert np.max(np.abs(Fc_s - Fc_d)) < 1.0E-5 * np.max(np.abs(Fc_d))